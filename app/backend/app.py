@@ -7,13 +7,17 @@ from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 from dotenv import load_dotenv
 
+from loopmonitor import LoopLagMonitor, SamplingProfiler
+from metrics import handle_metrics
+from ragcache import IndexChangeWatcher
 from ragtools import attach_rag_tools
 from rtmt import RTMiddleTier
+from tokencache import AsyncTokenCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
 
-async def create_app():
+async def create_app(serve_static: bool = True):
     if not os.environ.get("RUNNING_IN_PRODUCTION"):
         logger.info("Running in development mode, loading from .env file")
         load_dotenv()
@@ -40,6 +44,18 @@ async def create_app():
         deployment=os.environ["AZURE_OPENAI_REALTIME_DEPLOYMENT"],
         voice_choice=os.environ.get("AZURE_OPENAI_REALTIME_VOICE_CHOICE") or "alloy"
         )
+    rtmt.connection_pool_size = int(os.environ.get("AZURE_OPENAI_REALTIME_CONNECTION_POOL_SIZE") or 0)
+    rtmt.connection_pool_max_idle_seconds = float(os.environ.get("AZURE_OPENAI_REALTIME_CONNECTION_POOL_MAX_IDLE_SECONDS") or 60)
+    rtmt.relay_high_watermark_bytes = int(os.environ.get("AZURE_OPENAI_REALTIME_RELAY_HIGH_WATERMARK_BYTES") or 1048576)
+    rtmt.relay_low_watermark_bytes = int(os.environ.get("AZURE_OPENAI_REALTIME_RELAY_LOW_WATERMARK_BYTES") or 262144)
+    rtmt.max_sessions = int(os.environ.get("AZURE_OPENAI_REALTIME_MAX_SESSIONS") or 0)
+    rtmt.max_inflight_tool_calls = int(os.environ.get("AZURE_OPENAI_REALTIME_MAX_INFLIGHT_TOOL_CALLS") or 0)
+    rtmt.drain_timeout_seconds = float(os.environ.get("AZURE_OPENAI_REALTIME_DRAIN_TIMEOUT_SECONDS") or 25)
+    rtmt.slow_handler_seconds = float(os.environ.get("AZURE_OPENAI_REALTIME_SLOW_HANDLER_MS") or 20) / 1000
+    if silence_threshold := os.environ.get("AZURE_OPENAI_REALTIME_SILENCE_GATE_THRESHOLD_DBFS"):
+        rtmt.silence_gate_threshold_dbfs = float(silence_threshold)
+        rtmt.silence_gate_hangover_ms = float(os.environ.get("AZURE_OPENAI_REALTIME_SILENCE_GATE_HANGOVER_MS") or 1500)
+        rtmt.silence_gate_padding_ms = float(os.environ.get("AZURE_OPENAI_REALTIME_SILENCE_GATE_PADDING_MS") or 500)
     rtmt.system_message = """
         You are a helpful assistant. Only answer questions based on information you searched in the knowledge base, accessible with the 'search' tool. 
         The user is listening to answers with audio, so it's *super* important that answers are as short as possible, a single sentence if at all possible. 
@@ -50,7 +66,21 @@ async def create_app():
         3. Produce an answer that's as short as possible. If the answer isn't in the knowledge base, say you don't know.
     """.strip()
 
-    attach_rag_tools(rtmt,
+    backend = None
+    if os.environ.get("AZURE_SEARCH_BACKEND") == "local":
+        from localsearch import AzureOpenAIEmbedder, EmbeddedSearchBackend
+        embed = None
+        if embedding_deployment := os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"):
+            embed = AzureOpenAIEmbedder(os.environ["AZURE_OPENAI_ENDPOINT"], embedding_deployment, llm_credential,
+                                        dimensions=int(os.environ.get("AZURE_OPENAI_EMBEDDING_DIMENSIONS") or 0) or None)
+        backend = EmbeddedSearchBackend(os.environ["LOCAL_SEARCH_INDEX_PATH"], embed=embed)
+        if embed is not None:
+            async def close_embedder(app):
+                await embed.close()
+            app.on_cleanup.append(close_embedder)
+        logger.info("Using the embedded search index at %s with %d chunks", os.environ["LOCAL_SEARCH_INDEX_PATH"], len(backend))
+
+    grounding = attach_rag_tools(rtmt,
         credentials=search_credential,
         search_endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
         search_index=os.environ.get("AZURE_SEARCH_INDEX"),
@@ -59,14 +89,55 @@ async def create_app():
         content_field=os.environ.get("AZURE_SEARCH_CONTENT_FIELD") or "chunk",
         embedding_field=os.environ.get("AZURE_SEARCH_EMBEDDING_FIELD") or "text_vector",
         title_field=os.environ.get("AZURE_SEARCH_TITLE_FIELD") or "title",
-        use_vector_query=(os.getenv("AZURE_SEARCH_USE_VECTOR_QUERY", "true") == "true")
+        use_vector_query=(os.getenv("AZURE_SEARCH_USE_VECTOR_QUERY", "true") == "true"),
+        cache_max_entries=int(os.environ.get("AZURE_SEARCH_CACHE_MAX_ENTRIES") or 256),
+        cache_ttl_seconds=float(os.environ.get("AZURE_SEARCH_CACHE_TTL_SECONDS") or 300),
+        shared_chunk_cache_max_entries=int(os.environ.get("AZURE_SEARCH_CHUNK_CACHE_MAX_ENTRIES") or 1024),
+        speculative_search=(os.getenv("AZURE_SEARCH_SPECULATIVE_SEARCH", "false") == "true"),
+        result_max_tokens=int(os.environ.get("AZURE_SEARCH_RESULT_MAX_TOKENS") or 2500),
+        backend=backend,
+        search_deadline_seconds=float(os.environ.get("AZURE_SEARCH_DEADLINE_SECONDS") or 5),
+        hedge_search=(os.getenv("AZURE_SEARCH_HEDGE", "true") == "true"),
+        grounding_deadline_seconds=float(os.environ.get("AZURE_SEARCH_GROUNDING_DEADLINE_SECONDS") or 5)
         )
 
+    # Cached results would otherwise outlive a re-index by up to the cache TTL, the indexer's last run tells workers when it finished
+    if indexer_name := os.environ.get("AZURE_SEARCH_INDEXER"):
+        from azure.search.documents.indexes.aio import SearchIndexerClient
+        indexer_credential = search_credential if isinstance(search_credential, AzureKeyCredential) else AsyncTokenCache(search_credential, "https://search.azure.com/.default")
+        indexer_client = SearchIndexerClient(os.environ["AZURE_SEARCH_ENDPOINT"], indexer_credential)
+        async def last_indexer_run():
+            status = await indexer_client.get_indexer_status(indexer_name)
+            # A run in progress has no end time yet, any finished run may have changed documents even if it partly failed
+            return status.last_result.end_time if status.last_result is not None else None
+        IndexChangeWatcher(last_indexer_run, interval_seconds=float(os.environ.get("AZURE_SEARCH_INDEXER_POLL_SECONDS") or 60)).attach_to_app(app)
+        async def close_indexer_client(app):
+            await indexer_client.close()
+            if isinstance(indexer_credential, AsyncTokenCache):
+                await indexer_credential.close()
+        app.on_cleanup.append(close_indexer_client)
+
+    async def close_grounding(app):
+        await grounding.close()
+    app.on_cleanup.append(close_grounding)
+
     rtmt.attach_to_app(app, "/realtime")
+    app.add_routes([web.get("/metrics", handle_metrics), web.get("/load", rtmt.handle_load),
+                    web.get("/chunks", grounding.handle_chunks)])
+    LoopLagMonitor(warn_seconds=float(os.environ.get("EVENT_LOOP_LAG_WARNING_MS") or 100) / 1000).attach_to_app(app)
+    # Like the profiler, draining is only reachable when a token is configured
+    if drain_token := os.environ.get("DRAIN_TOKEN"):
+        rtmt.drain_token = drain_token
+        app.add_routes([web.post("/drain", rtmt.handle_drain)])
+    # The profiler is only reachable when a token is configured, and only by callers presenting it
+    if profiler_token := os.environ.get("PROFILER_TOKEN"):
+        app.add_routes([web.get("/debug/profile", SamplingProfiler(profiler_token).handle_profile)])
 
-    current_directory = Path(__file__).parent
-    app.add_routes([web.get('/', lambda _: web.FileResponse(current_directory / 'static/index.html'))])
-    app.router.add_static('/', path=current_directory / 'static', name='static')
+    # The frontend build, skipped by the load generator so it runs without building the frontend first
+    if serve_static:
+        current_directory = Path(__file__).parent
+        app.add_routes([web.get('/', lambda _: web.FileResponse(current_directory / 'static/index.html'))])
+        app.router.add_static('/', path=current_directory / 'static', name='static')
     
     return app
 
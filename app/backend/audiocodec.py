@@ -0,0 +1,57 @@
+import numpy as np
+
+# G.711 companding for the browser leg. Upstream audio stays 24kHz PCM16, only the sample width changes, so
+# transcoding is a table lookup per sample: 65536 entries indexed by the raw 16-bit sample, 256 entries back.
+
+def _ulaw_tables() -> tuple[np.ndarray, np.ndarray]:
+    bias = 0x84
+    # Encoding follows the Sun reference implementation on 14-bit samples
+    samples = np.arange(-32768, 32768, dtype=np.int32) >> 2
+    mask = np.where(samples < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(samples), 8159) + 0x21
+    segment = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), magnitude)
+    encoded = np.where(segment >= 8, 0x7F, (np.minimum(segment, 7) << 4) | ((magnitude >> (segment + 1)) & 0x0F)) ^ mask
+
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    decoded = (((codes & 0x0F) << 3) + bias) << ((codes >> 4) & 0x07)
+    decoded = np.where(codes & 0x80, bias - decoded, decoded - bias)
+    return _by_raw_sample(encoded), decoded.astype("<i2")
+
+def _alaw_tables() -> tuple[np.ndarray, np.ndarray]:
+    samples = np.arange(-32768, 32768, dtype=np.int32) >> 3
+    mask = np.where(samples >= 0, 0xD5, 0x55)
+    magnitude = np.where(samples >= 0, samples, -samples - 1)
+    segment = np.searchsorted(np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF]), magnitude)
+    mantissa = np.where(segment < 2, magnitude >> 1, magnitude >> np.maximum(segment, 1)) & 0x0F
+    encoded = np.where(segment >= 8, 0x7F, (np.minimum(segment, 7) << 4) | mantissa) ^ mask
+
+    codes = np.arange(256, dtype=np.int32) ^ 0x55
+    segment = (codes & 0x70) >> 4
+    decoded = ((codes & 0x0F) << 4) + np.where(segment == 0, 8, 0x108)
+    decoded = np.where(segment > 1, decoded << np.maximum(segment - 1, 0), decoded)
+    decoded = np.where(codes & 0x80, decoded, -decoded)
+    return _by_raw_sample(encoded), decoded.astype("<i2")
+
+def _by_raw_sample(encoded: np.ndarray) -> np.ndarray:
+    # Reorder from sample value order (-32768..32767) to the unsigned view of the little-endian sample
+    return np.roll(encoded.astype(np.uint8), -32768)
+
+class G711Codec:
+    """Converts between 16-bit little-endian PCM and one byte per sample G.711."""
+    name: str
+
+    def __init__(self, name: str, encode_table: np.ndarray, decode_table: np.ndarray):
+        self.name = name
+        self._encode_table = encode_table
+        self._decode_table = decode_table
+
+    def encode(self, pcm: bytes) -> bytes:
+        return self._encode_table[np.frombuffer(pcm, dtype="<u2")].tobytes()
+
+    def decode(self, data: bytes) -> bytes:
+        return self._decode_table[np.frombuffer(data, dtype=np.uint8)].tobytes()
+
+CODECS = {
+    "g711_ulaw": G711Codec("g711_ulaw", *_ulaw_tables()),
+    "g711_alaw": G711Codec("g711_alaw", *_alaw_tables())
+}
@@ -0,0 +1,83 @@
+"""Measures the middle tier's per-frame audio work for each client audio format, in CPU time per second of audio.
+
+Run from app/backend, e.g.: python -m bench.codec --frame-ms 100
+
+Each format is timed for both directions as the middle tier does it: client frame to upstream append event, and
+upstream audio delta to client frame. Divide the reported audio seconds per CPU second by the number of concurrent
+speakers you expect per worker to see how much of a core transcoding takes."""
+import argparse
+import base64
+import json
+import time
+
+import numpy as np
+
+from audiocodec import CODECS
+from rtmt import _audio_append_event, _audio_delta_pcm
+
+SAMPLE_RATE = 24000
+
+def _speech_like(seconds: float) -> bytes:
+    # Noisy tone with a slow envelope, so compressed formats see a realistic spread of sample values
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    rng = np.random.default_rng(0)
+    signal = 0.3 * np.sin(2 * np.pi * 220 * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)) + 0.05 * rng.standard_normal(len(t))
+    return (np.clip(signal, -1, 1) * 32767).astype("<i2").tobytes()
+
+def _time_per_audio_second(work, frames: list, frame_seconds: float, min_seconds: float) -> float:
+    rounds = 0
+    started_at = time.process_time()
+    while True:
+        for frame in frames:
+            work(frame)
+        rounds += 1
+        elapsed = time.process_time() - started_at
+        if elapsed >= min_seconds:
+            return elapsed / (rounds * len(frames) * frame_seconds)
+
+def run(args: argparse.Namespace) -> list[dict[str, float | str]]:
+    frame_seconds = args.frame_ms / 1000
+    frame_bytes = int(SAMPLE_RATE * frame_seconds) * 2
+    pcm = _speech_like(args.audio_seconds)
+    pcm_frames = [pcm[i:i + frame_bytes] for i in range(0, len(pcm) - frame_bytes + 1, frame_bytes)]
+    deltas = [json.dumps({"type": "response.audio.delta", "event_id": "event_1", "response_id": "resp_1", "item_id": "item_1",
+                          "output_index": 0, "content_index": 0, "delta": base64.b64encode(frame).decode()}) for frame in pcm_frames]
+
+    formats = {
+        "json": (lambda frame: None, lambda delta: None, None),
+        "binary": (_audio_append_event, _audio_delta_pcm, None),
+        **{name: (lambda frame, codec=codec: _audio_append_event(codec.decode(frame)),
+                  lambda delta, codec=codec: codec.encode(_audio_delta_pcm(delta)),
+                  codec) for name, codec in CODECS.items()}
+    }
+    results = []
+    for name, (to_server, to_client, codec) in formats.items():
+        client_frames = [codec.encode(frame) for frame in pcm_frames] if codec is not None else pcm_frames
+        to_server_cost = _time_per_audio_second(to_server, client_frames, frame_seconds, args.min_seconds)
+        to_client_cost = _time_per_audio_second(to_client, deltas, frame_seconds, args.min_seconds)
+        # JSON relays audio events untouched, base64 in a JSON string is what goes over the wire
+        client_bytes = len(deltas[0]) if name == "json" else len(client_frames[0])
+        results.append({
+            "format": name,
+            "client_kb_per_audio_second": client_bytes / frame_seconds / 1024,
+            "to_server_us_per_audio_second": to_server_cost * 1e6,
+            "to_client_us_per_audio_second": to_client_cost * 1e6,
+            "audio_seconds_per_cpu_second": 1 / (to_server_cost + to_client_cost) if to_server_cost + to_client_cost else float("inf")
+        })
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark middle tier audio translation and transcoding per second of audio")
+    parser.add_argument("--frame-ms", type=float, default=100, help="Audio per frame, the frontend sends 100ms frames")
+    parser.add_argument("--audio-seconds", type=float, default=10, help="Length of the generated test audio")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Minimum CPU time spent timing each direction of each format")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        columns = list(results[0])
+        print("  ".join(f"{c:>30}" for c in columns))
+        for row in results:
+            print("  ".join(f"{row[c]:>30.2f}" if isinstance(row[c], float) else f"{row[c]:>30}" for c in columns))
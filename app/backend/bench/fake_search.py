@@ -0,0 +1,39 @@
+import asyncio
+import random
+from collections.abc import AsyncIterator
+from typing import Any, Optional
+
+
+class FakeSearchClient:
+    """Drop-in for azure.search.documents.aio.SearchClient that answers from generated chunks after a configurable delay."""
+    latency: float
+    jitter: float
+    chunk_length: int
+    calls: int
+
+    def __init__(self, endpoint: Optional[str] = None, index_name: Optional[str] = None, credential: Any = None,
+                 latency: float = 0.3, jitter: float = 0.1, chunk_length: int = 2000, **kwargs: Any):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_length = chunk_length
+        self.calls = 0
+
+    def _chunk(self, chunk_id: str) -> dict[str, Any]:
+        return {"chunk_id": chunk_id, "title": f"{chunk_id}.pdf", "chunk": (f"Contents of {chunk_id}. " * self.chunk_length)[:self.chunk_length]}
+
+    async def search(self, search_text: Optional[str] = None, top: Optional[int] = None, search_fields: Optional[list[str]] = None, **kwargs: Any) -> AsyncIterator[dict[str, Any]]:
+        self.calls += 1
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if search_fields:
+            # Lookup by identifier, as done by report_grounding
+            docs = [self._chunk(chunk_id) for chunk_id in (search_text or "").split(" OR ")][:top]
+        else:
+            docs = [self._chunk(f"chunk_{i}") for i in range(top or 5)]
+        return _iterate(docs)
+
+    async def close(self) -> None:
+        pass
+
+async def _iterate(docs: list[dict[str, Any]]) -> AsyncIterator[dict[str, Any]]:
+    for doc in docs:
+        yield doc
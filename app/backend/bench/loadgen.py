@@ -0,0 +1,224 @@
+"""Drives N concurrent simulated voice clients through create_app() against a local mock of the realtime API.
+
+Run from app/backend, e.g.: python -m bench.loadgen --sessions 200 --turns 3
+
+The middle tier runs alone in this process so CPU time and memory growth can be attributed to it, the mock
+realtime API and the simulated browsers share a second process."""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import time
+from typing import Any, Optional
+
+import aiohttp
+from aiohttp import web
+
+from audiocodec import CODECS
+from bench.fake_search import FakeSearchClient
+from bench.mock_realtime import MockRealtimeConfig, create_mock_app
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current, still good enough for a growth estimate
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class _ClientStats:
+    def __init__(self):
+        self.events = 0
+        self.frames_sent = 0
+        self.turns = 0
+        self.errors = 0
+        self.relay_latencies: list[float] = []
+        self.first_audio_latencies: list[float] = []
+
+async def _run_client(session: aiohttp.ClientSession, url: str, args: argparse.Namespace, stats: _ClientStats) -> None:
+    frame = json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(bytes(args.frame_bytes)).decode()})
+    pcm_frame = bytes(args.frame_bytes)
+    if args.codec:
+        pcm_frame = CODECS[args.codec].encode(pcm_frame)
+    turn_done = asyncio.Event()
+
+    async def receive(ws: aiohttp.ClientWebSocketResponse) -> None:
+        committed_at = None
+        async for msg in ws:
+            now = time.monotonic()
+            stats.events += 1
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                # Answer audio in binary mode, carries no send timestamp
+                if committed_at is not None:
+                    stats.first_audio_latencies.append(now - committed_at)
+                    committed_at = None
+                continue
+            event = json.loads(msg.data)
+            if "mock_sent_at" in event:
+                stats.relay_latencies.append(now - event["mock_sent_at"])
+            if event["type"] == "input_audio_buffer.committed":
+                committed_at = now
+            elif event["type"] == "response.audio.delta" and committed_at is not None:
+                stats.first_audio_latencies.append(now - committed_at)
+                committed_at = None
+            elif event["type"] == "response.done" and any(o.get("type") == "message" for o in event["response"]["output"]):
+                turn_done.set()
+
+    try:
+        async with session.ws_connect(url) as ws:
+            receiver = asyncio.create_task(receive(ws))
+            try:
+                await ws.send_str(json.dumps({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}}))
+                for _ in range(args.turns):
+                    for _ in range(args.frames_per_turn):
+                        if args.binary_audio or args.codec:
+                            await ws.send_bytes(pcm_frame)
+                        else:
+                            await ws.send_str(frame)
+                        stats.frames_sent += 1
+                        await asyncio.sleep(args.frame_interval)
+                    await asyncio.wait_for(turn_done.wait(), timeout=args.turn_timeout)
+                    turn_done.clear()
+                    stats.turns += 1
+            finally:
+                receiver.cancel()
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        stats.errors += 1
+
+async def _drive(conn: Any, args: argparse.Namespace) -> None:
+    config = MockRealtimeConfig(frames_per_turn=args.frames_per_turn, audio_deltas=args.audio_deltas, delta_interval=args.delta_interval,
+                                tool_rounds=[r.split(",") for r in args.tool_rounds.split(";") if r])
+    runner = web.AppRunner(create_mock_app(config))
+    await runner.setup()
+    mock_port = _free_port()
+    await web.TCPSite(runner, "127.0.0.1", mock_port).start()
+    conn.send(mock_port)
+
+    url = await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    stats = _ClientStats()
+    started_at = time.monotonic()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        clients = []
+        for _ in range(args.sessions):
+            clients.append(asyncio.create_task(_run_client(session, url, args, stats)))
+            await asyncio.sleep(args.ramp_up / max(args.sessions, 1))
+        await asyncio.gather(*clients)
+    conn.send({
+        "duration": time.monotonic() - started_at,
+        "events": stats.events,
+        "frames_sent": stats.frames_sent,
+        "turns": stats.turns,
+        "errors": stats.errors,
+        "relay_latencies": stats.relay_latencies,
+        "first_audio_latencies": stats.first_audio_latencies
+    })
+    await runner.cleanup()
+
+def _driver_main(conn: Any, args: argparse.Namespace) -> None:
+    asyncio.run(_drive(conn, args))
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    parent_conn, child_conn = multiprocessing.Pipe()
+    driver = multiprocessing.get_context("spawn").Process(target=_driver_main, args=(child_conn, args), daemon=True)
+    driver.start()
+    loop = asyncio.get_running_loop()
+    mock_port = await loop.run_in_executor(None, parent_conn.recv)
+
+    os.environ.update({
+        "RUNNING_IN_PRODUCTION": "1",
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{mock_port}",
+        "AZURE_OPENAI_REALTIME_DEPLOYMENT": "bench",
+        "AZURE_OPENAI_API_KEY": "bench",
+        "AZURE_SEARCH_ENDPOINT": "https://bench.search.windows.net",
+        "AZURE_SEARCH_INDEX": "bench",
+        "AZURE_SEARCH_API_KEY": "bench"
+    })
+    import ragtools
+    from app import create_app
+    ragtools.SearchClient = lambda *a, **kw: FakeSearchClient(*a, latency=args.search_latency, jitter=args.search_jitter, **kw)
+
+    app = await create_app(serve_static=False)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = _free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    peak_rss = baseline_rss = _rss_bytes()
+    async def sample_memory():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, _rss_bytes())
+            await asyncio.sleep(0.1)
+    sampler = asyncio.create_task(sample_memory())
+
+    cpu_started_at = time.process_time()
+    audio = args.codec or ("binary" if args.binary_audio else None)
+    parent_conn.send(f"http://127.0.0.1:{port}/realtime" + (f"?audio={audio}" if audio else ""))
+    # The relay and the tools log every session and query, keep the report readable
+    logging.getLogger("voicerag").setLevel(logging.WARNING)
+    result = await loop.run_in_executor(None, parent_conn.recv)
+    cpu_seconds = time.process_time() - cpu_started_at
+    sampler.cancel()
+    await runner.cleanup()
+    driver.join(timeout=10)
+
+    relay = result.pop("relay_latencies")
+    first_audio = result.pop("first_audio_latencies")
+    session_seconds = args.sessions * result["duration"]
+    return {
+        **result,
+        "sessions": args.sessions,
+        "events_per_second": result["events"] / result["duration"],
+        "relay_p50_ms": _percentile(relay, 0.5) * 1000,
+        "relay_p99_ms": _percentile(relay, 0.99) * 1000,
+        "first_audio_p50_ms": _percentile(first_audio, 0.5) * 1000,
+        "first_audio_p99_ms": _percentile(first_audio, 0.99) * 1000,
+        "cpu_ms_per_session": cpu_seconds * 1000 / args.sessions,
+        "cpu_percent_per_session": cpu_seconds * 100 / session_seconds if session_seconds else 0.0,
+        "memory_kb_per_session": max(0, peak_rss - baseline_rss) / 1024 / args.sessions
+    }
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test RTMiddleTier against a local mock realtime API")
+    parser.add_argument("--sessions", type=int, default=50, help="Concurrent simulated clients")
+    parser.add_argument("--turns", type=int, default=3, help="Questions asked by each client")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds over which clients connect")
+    parser.add_argument("--frames-per-turn", type=int, default=25, help="Microphone frames sent per question")
+    parser.add_argument("--frame-bytes", type=int, default=4800, help="PCM16 bytes per microphone frame (4800 is 100ms at 24kHz)")
+    parser.add_argument("--frame-interval", type=float, default=0.1, help="Seconds between microphone frames, 0.1 is real time")
+    parser.add_argument("--audio-deltas", type=int, default=20, help="Audio deltas in each answer")
+    parser.add_argument("--delta-interval", type=float, default=0.01, help="Seconds between answer audio deltas")
+    parser.add_argument("--tool-rounds", default="search;report_grounding", help="Tool calls per response, responses separated by ';' and calls by ','")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="Mean fake Azure AI Search latency in seconds")
+    parser.add_argument("--search-jitter", type=float, default=0.1, help="Uniform jitter added to the fake search latency")
+    parser.add_argument("--binary-audio", action="store_true", help="Exchange audio as binary PCM16 frames (?audio=binary) instead of base64 JSON events")
+    parser.add_argument("--codec", choices=sorted(CODECS), help="Exchange audio as binary frames in this G.711 variant")
+    parser.add_argument("--turn-timeout", type=float, default=30.0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for name, value in report.items():
+            print(f"{name:>26}: {value:.2f}" if isinstance(value, float) else f"{name:>26}: {value}")
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import time
+from typing import Any
+
+from aiohttp import web
+
+
+class MockRealtimeConfig:
+    """Shape of the conversation the mock realtime API plays back for every user turn."""
+    # Number of input_audio_buffer.append frames that make up one user turn before the buffer is committed
+    frames_per_turn: int = 25
+    # Tool calls the model makes before answering, one list per response, e.g. [["search"], ["report_grounding"]]
+    tool_rounds: list[list[str]] = [["search"], ["report_grounding"]]
+    # Answer audio, sent as this many deltas of delta_bytes PCM16 bytes, delta_interval seconds apart
+    audio_deltas: int = 20
+    delta_bytes: int = 4800
+    delta_interval: float = 0.01
+    # Delay before the first event of each response, standing in for model think time
+    response_delay: float = 0.05
+    transcript: str = "What does my plan cover for dental?"
+    search_query: str = "dental coverage"
+    grounding_sources: list[str] = ["chunk_0"]
+
+    def __init__(self, **kwargs: Any):
+        for name, value in kwargs.items():
+            if not hasattr(MockRealtimeConfig, name):
+                raise AttributeError(f"Unknown mock realtime setting: {name}")
+            setattr(self, name, value)
+
+class _MockConnection:
+    def __init__(self, ws: web.WebSocketResponse, config: MockRealtimeConfig, ids: itertools.count):
+        self.ws = ws
+        self.config = config
+        self.ids = ids
+        self.frames = 0
+        self.round = 0
+        self.transcription = False
+        self.audio = base64.b64encode(bytes(config.delta_bytes)).decode()
+        self.tasks: set[asyncio.Task] = set()
+
+    def next_id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self.ids)}"
+
+    async def send(self, event: dict[str, Any]) -> None:
+        # Same-process clients use this to measure how long the middle tier held on to the event
+        event["mock_sent_at"] = time.monotonic()
+        await self.ws.send_str(json.dumps(event))
+
+    def spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, event: dict[str, Any]) -> None:
+        event_type = event["type"]
+        if event_type == "session.update":
+            self.transcription = bool(event["session"].get("input_audio_transcription"))
+            await self.send({"type": "session.updated", "event_id": self.next_id("event"), "session": event["session"]})
+        elif event_type == "input_audio_buffer.append":
+            self.frames += 1
+            if self.frames >= self.config.frames_per_turn:
+                self.frames = 0
+                self.round = 0
+                self.spawn(self.commit_turn())
+        elif event_type == "response.create":
+            self.round += 1
+            self.spawn(self.respond())
+
+    async def commit_turn(self) -> None:
+        item_id = self.next_id("item")
+        await self.send({"type": "input_audio_buffer.committed", "event_id": self.next_id("event"), "previous_item_id": None, "item_id": item_id})
+        if self.transcription:
+            await self.send({"type": "conversation.item.input_audio_transcription.completed", "event_id": self.next_id("event"),
+                             "item_id": item_id, "content_index": 0, "transcript": self.config.transcript})
+        await self.respond()
+
+    def tool_arguments(self, name: str) -> dict[str, Any]:
+        if name == "search":
+            return {"query": self.config.search_query}
+        if name == "report_grounding":
+            return {"sources": self.config.grounding_sources}
+        return {}
+
+    async def respond(self) -> None:
+        await asyncio.sleep(self.config.response_delay)
+        response_id = self.next_id("resp")
+        await self.send({"type": "response.created", "event_id": self.next_id("event"), "response": {"id": response_id, "status": "in_progress", "output": []}})
+        if self.round < len(self.config.tool_rounds):
+            outputs = []
+            previous_item_id = None
+            for index, name in enumerate(self.config.tool_rounds[self.round]):
+                item = {"id": self.next_id("item"), "type": "function_call", "status": "completed", "name": name,
+                        "call_id": self.next_id("call"), "arguments": json.dumps(self.tool_arguments(name))}
+                await self.send({"type": "response.output_item.added", "event_id": self.next_id("event"), "response_id": response_id, "output_index": index, "item": {**item, "arguments": ""}})
+                await self.send({"type": "conversation.item.created", "event_id": self.next_id("event"), "previous_item_id": previous_item_id, "item": item})
+                await self.send({"type": "response.function_call_arguments.done", "event_id": self.next_id("event"), "response_id": response_id,
+                                 "item_id": item["id"], "output_index": index, "call_id": item["call_id"], "arguments": item["arguments"]})
+                await self.send({"type": "response.output_item.done", "event_id": self.next_id("event"), "response_id": response_id, "output_index": index, "item": item})
+                outputs.append(item)
+                previous_item_id = item["id"]
+            await self.send({"type": "response.done", "event_id": self.next_id("event"), "response": {"id": response_id, "status": "completed", "output": outputs}})
+            return
+
+        item_id = self.next_id("item")
+        message = {"id": item_id, "type": "message", "status": "completed", "role": "assistant", "content": [{"type": "audio", "transcript": "Dental is covered."}]}
+        await self.send({"type": "response.output_item.added", "event_id": self.next_id("event"), "response_id": response_id, "output_index": 0, "item": {**message, "status": "in_progress", "content": []}})
+        for _ in range(self.config.audio_deltas):
+            await self.send({"type": "response.audio.delta", "event_id": self.next_id("event"), "response_id": response_id,
+                             "item_id": item_id, "output_index": 0, "content_index": 0, "delta": self.audio})
+            await self.send({"type": "response.audio_transcript.delta", "event_id": self.next_id("event"), "response_id": response_id,
+                             "item_id": item_id, "output_index": 0, "content_index": 0, "delta": "Dental "})
+            await asyncio.sleep(self.config.delta_interval)
+        await self.send({"type": "response.audio.done", "event_id": self.next_id("event"), "response_id": response_id, "item_id": item_id, "output_index": 0, "content_index": 0})
+        await self.send({"type": "response.done", "event_id": self.next_id("event"), "response": {"id": response_id, "status": "completed", "output": [message]}})
+
+def create_mock_app(config: MockRealtimeConfig) -> web.Application:
+    """A local stand-in for the Azure OpenAI /openai/realtime websocket that plays back a scripted conversation."""
+    ids = itertools.count(1)
+
+    async def realtime_handler(request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        connection = _MockConnection(ws, config, ids)
+        await connection.send({"type": "session.created", "event_id": connection.next_id("event"), "session": {
+            "id": connection.next_id("sess"), "object": "realtime.session", "model": "gpt-4o-realtime-preview", "modalities": ["audio", "text"],
+            "instructions": "", "voice": "alloy", "input_audio_format": "pcm16", "output_audio_format": "pcm16", "input_audio_transcription": None,
+            "turn_detection": {"type": "server_vad"}, "tools": [], "tool_choice": "auto", "temperature": 0.8, "max_response_output_tokens": "inf"}})
+        try:
+            async for msg in ws:
+                await connection.handle(json.loads(msg.data))
+        finally:
+            for task in connection.tasks:
+                task.cancel()
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/openai/realtime", realtime_handler)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local mock of the Azure OpenAI realtime API")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--delta-interval", type=float, default=MockRealtimeConfig.delta_interval)
+    parser.add_argument("--tool-rounds", default="search;report_grounding", help="Tool calls per response, responses separated by ';' and calls by ','")
+    args = parser.parse_args()
+    rounds = [r.split(",") for r in args.tool_rounds.split(";") if r]
+    web.run_app(create_mock_app(MockRealtimeConfig(delta_interval=args.delta_interval, tool_rounds=rounds)), host="localhost", port=args.port)
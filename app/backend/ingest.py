@@ -0,0 +1,192 @@
+"""Chunks the documents in data/ locally the way the search skillset does, to preview, test and profile chunking
+without running the indexer, and to feed the embedded search index (localsearch.py).
+
+Run from the repository root, e.g.: python app/backend/ingest.py data .ingest"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Optional
+
+logger = logging.getLogger("voicerag")
+
+# Same as the SplitSkill in setup_intvect.setup_index
+MAXIMUM_PAGE_LENGTH = 2000
+PAGE_OVERLAP_LENGTH = 500
+
+def extract_pages(path: str) -> list[str]:
+    """Text of a document, one entry per PDF page, a single entry for text formats."""
+    if path.lower().endswith(".pdf"):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise RuntimeError("Extracting text from PDF files requires pypdf, pip install pypdf")
+        return [page.extract_text() or "" for page in PdfReader(path).pages]
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return [f.read()]
+
+def _page_end(text: str, lo: int, hi: int) -> int:
+    # Prefer ending a page after a sentence, then at a word boundary, cutting mid-word only when neither exists
+    cut = max(text.rfind(separator, lo, hi + len(separator) - 1) for separator in (". ", "! ", "? ", "\n"))
+    if cut >= lo:
+        return cut + 1
+    cut = text.rfind(" ", lo, hi)
+    return cut if cut > lo else hi
+
+def split_pages(text: str, maximum_page_length: int = MAXIMUM_PAGE_LENGTH, page_overlap_length: int = PAGE_OVERLAP_LENGTH) -> list[str]:
+    """Splits text into pages of at most maximum_page_length characters, each starting with the last
+    page_overlap_length characters (give or take a word) of the previous one.
+
+    Pages are slices of text, so the overlap between consecutive pages is an exact prefix/suffix match."""
+    pages = []
+    start, previous_end, length = 0, 0, len(text)
+    while start < length:
+        end = min(length, start + maximum_page_length)
+        if end < length:
+            end = _page_end(text, max(start + maximum_page_length // 2, previous_end + 1), end)
+        if text[start:end].strip():
+            pages.append(text[start:end])
+        if end >= length:
+            break
+        start = max(start + 1, end - page_overlap_length)
+        # Start the overlap at the beginning of a word
+        if not text[start - 1].isspace():
+            space = text.find(" ", start, end)
+            start = space + 1 if space != -1 else start
+        while start < end and text[start].isspace():
+            start += 1
+        previous_end = end
+    return pages
+
+def document_key(url: str) -> str:
+    """The indexer's base64 key encoding of a blob's metadata_storage_path, which becomes a chunk's parent_id."""
+    encoded = base64.urlsafe_b64encode(url.encode("utf-8")).decode("ascii")
+    padding = encoded.count("=")
+    return encoded.rstrip("=") + str(padding)
+
+def chunk_id(parent_id: str, index: int) -> str:
+    # Index projections name chunks {hash}_{parent_id}_pages_{n}, the hash here is derived locally
+    suffix = f"{parent_id}_pages_{index}"
+    return f"{hashlib.md5(suffix.encode('ascii')).hexdigest()[:12]}_{suffix}"
+
+def process_document(path: str, url: str, maximum_page_length: int, page_overlap_length: int) -> dict[str, Any]:
+    pages = extract_pages(path)
+    # Document cracking hands the skillset the whole document as one string
+    chunks = split_pages("\n".join(pages), maximum_page_length, page_overlap_length)
+    parent_id = document_key(url)
+    title = os.path.basename(path)
+    return {
+        "parent_id": parent_id,
+        "pages": len(pages),
+        "chunks": [{"chunk_id": chunk_id(parent_id, i), "parent_id": parent_id, "title": title, "chunk": chunk} for i, chunk in enumerate(chunks)]
+    }
+
+def _file_md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            md5.update(block)
+    return md5.hexdigest()
+
+def ingest(data_path: str, out_path: str, storage_url: Optional[str] = None, workers: Optional[int] = None,
+           maximum_page_length: int = MAXIMUM_PAGE_LENGTH, page_overlap_length: int = PAGE_OVERLAP_LENGTH) -> dict[str, Any]:
+    """Writes out_path/chunks.jsonl for the documents in data_path, redoing only documents that changed since the last run.
+
+    storage_url is the blob container URL the documents are uploaded to, so parent ids match the ones in the index."""
+    os.makedirs(out_path, exist_ok=True)
+    manifest_path = os.path.join(out_path, "manifest.json")
+    chunks_path = os.path.join(out_path, "chunks.jsonl")
+    settings = {"maximum_page_length": maximum_page_length, "page_overlap_length": page_overlap_length, "storage_url": storage_url}
+    manifest = {"settings": settings, "documents": {}}
+    if os.path.exists(manifest_path) and os.path.exists(chunks_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        # Different settings change every chunk, start over
+        if previous.get("settings") == settings:
+            manifest = previous
+
+    documents = manifest["documents"]
+    files = {file.name: file for file in os.scandir(data_path) if file.is_file() and not file.name.startswith(".")}
+    changed = []
+    for name, file in files.items():
+        stat = file.stat()
+        entry = documents.get(name)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            continue
+        md5 = _file_md5(file.path)
+        if entry is not None and entry["md5"] == md5:
+            entry["mtime_ns"] = stat.st_mtime_ns
+            continue
+        documents[name] = {"md5": md5, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        changed.append(name)
+    removed = [name for name in documents if name not in files]
+    for name in removed:
+        del documents[name]
+
+    started_at = time.perf_counter()
+    results = {}
+    if changed:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_document, files[name].path, f"{storage_url.rstrip('/')}/{name}" if storage_url else name,
+                                       maximum_page_length, page_overlap_length): name for name in changed}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logger.error("Could not process %s: %s", name, e)
+                    del documents[name]
+                    continue
+                documents[name].update(parent_id=results[name]["parent_id"], pages=results[name]["pages"], chunks=len(results[name]["chunks"]))
+                logger.info("Chunked %s: %d pages, %d chunks", name, results[name]["pages"], len(results[name]["chunks"]))
+    elapsed = time.perf_counter() - started_at
+
+    # Chunks of unchanged documents are carried over from the previous store
+    kept_parents = {entry["parent_id"] for name, entry in documents.items() if name not in results and "parent_id" in entry}
+    temporary_path = chunks_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as out:
+        if kept_parents and os.path.exists(chunks_path):
+            with open(chunks_path, encoding="utf-8") as previous_chunks:
+                for line in previous_chunks:
+                    if json.loads(line)["parent_id"] in kept_parents:
+                        out.write(line)
+        for result in results.values():
+            for chunk in result["chunks"]:
+                out.write(json.dumps(chunk) + "\n")
+    os.replace(temporary_path, chunks_path)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    pages = sum(result["pages"] for result in results.values())
+    return {
+        "documents_processed": len(results),
+        "documents_unchanged": len(files) - len(changed),
+        "documents_removed": len(removed),
+        "pages": pages,
+        "chunks": sum(len(result["chunks"]) for result in results.values()),
+        "seconds": elapsed,
+        "pages_per_second": pages / elapsed if elapsed else 0.0
+    }
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Chunk documents locally with the same settings as the search skillset")
+    parser.add_argument("data", nargs="?", default="data", help="Folder with the documents")
+    parser.add_argument("out", nargs="?", default=".ingest", help="Folder for chunks.jsonl and the manifest")
+    parser.add_argument("--storage-url", default=None, help="Blob container URL the documents are uploaded to, defaults to "
+                        "AZURE_STORAGE_ENDPOINT/AZURE_STORAGE_CONTAINER when set, so parent ids match the index")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to the number of CPUs")
+    parser.add_argument("--maximum-page-length", type=int, default=MAXIMUM_PAGE_LENGTH)
+    parser.add_argument("--page-overlap-length", type=int, default=PAGE_OVERLAP_LENGTH)
+    args = parser.parse_args()
+    storage_url = args.storage_url
+    if storage_url is None and os.environ.get("AZURE_STORAGE_ENDPOINT") and os.environ.get("AZURE_STORAGE_CONTAINER"):
+        storage_url = f"{os.environ['AZURE_STORAGE_ENDPOINT'].rstrip('/')}/{os.environ['AZURE_STORAGE_CONTAINER']}"
+    report = ingest(args.data, args.out, storage_url, args.workers, args.maximum_page_length, args.page_overlap_length)
+    logger.info("Processed %d documents (%d unchanged, %d removed): %d pages, %d chunks in %.2fs, %.1f pages/s",
+                report["documents_processed"], report["documents_unchanged"], report["documents_removed"],
+                report["pages"], report["chunks"], report["seconds"], report["pages_per_second"])
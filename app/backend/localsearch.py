@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import json
+import math
+import re
+import time
+from collections import Counter
+from collections.abc import Awaitable, Callable, Hashable, Iterable
+from pathlib import Path
+from typing import Any, Optional
+
+import aiohttp
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+
+from retrieval import RetrievalBackend, lookup_seconds, search_seconds
+from tokencache import AsyncTokenCache
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.casefold())
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def build_index(chunks: Iterable[dict[str, Any]], path: str | Path, k1: float = 1.2, b: float = 0.75) -> int:
+    """Writes an index for EmbeddedSearchBackend from chunks with "chunk_id", "title", "chunk" and optionally "text_vector" keys.
+
+    The index is a directory of .npy arrays (memory-mapped when loaded) plus a meta.json with the vocabulary and chunk text."""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    docs = []
+    vectors = []
+    term_ids: dict[str, int] = {}
+    postings: list[list[tuple[int, int]]] = []
+    doc_lengths = []
+    for chunk in chunks:
+        doc_index = len(docs)
+        docs.append({"chunk_id": chunk["chunk_id"], "title": chunk.get("title", ""), "chunk": chunk["chunk"]})
+        if chunk.get("text_vector") is not None:
+            vectors.append(chunk["text_vector"])
+        terms = tokenize(f"{chunk.get('title', '')} {chunk['chunk']}")
+        doc_lengths.append(len(terms))
+        for term, tf in Counter(terms).items():
+            term_id = term_ids.setdefault(term, len(term_ids))
+            if term_id == len(postings):
+                postings.append([])
+            postings[term_id].append((doc_index, tf))
+
+    # Postings in CSR layout: the documents containing term t are postings_docs[term_offsets[t]:term_offsets[t + 1]]
+    term_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(p) for p in postings])
+    postings_docs = np.fromiter((d for p in postings for d, _ in p), dtype=np.int32, count=int(term_offsets[-1]))
+    postings_tf = np.fromiter((tf for p in postings for _, tf in p), dtype=np.float32, count=int(term_offsets[-1]))
+    np.save(path / "term_offsets.npy", term_offsets)
+    np.save(path / "postings_docs.npy", postings_docs)
+    np.save(path / "postings_tf.npy", postings_tf)
+    np.save(path / "doc_lengths.npy", np.asarray(doc_lengths, dtype=np.float32))
+    has_vectors = len(docs) > 0 and len(vectors) == len(docs)
+    if has_vectors:
+        np.save(path / "embeddings.npy", _normalize_rows(np.asarray(vectors, dtype=np.float32)))
+    elif (path / "embeddings.npy").exists():
+        (path / "embeddings.npy").unlink()
+
+    meta = {
+        "version": 1,
+        "k1": k1,
+        "b": b,
+        "avgdl": float(np.mean(doc_lengths)) if doc_lengths else 0.0,
+        "terms": sorted(term_ids, key=term_ids.get),
+        "chunks": docs
+    }
+    with open(path / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return len(docs)
+
+class EmbeddedSearchBackend(RetrievalBackend):
+    """In-process hybrid retrieval for small, mostly static knowledge bases.
+
+    BM25 over an inverted index and brute-force cosine similarity over normalized embeddings, combined with
+    reciprocal rank fusion. Vector retrieval needs an embed callable for queries and an index built with vectors."""
+    name = "embedded"
+    # Candidates taken from each ranking before fusion, mirrors k_nearest_neighbors used with Azure AI Search
+    candidates: int = 50
+    rrf_k: int = 60
+    # Rows scored per matrix product, bounds temporary memory and keeps mapped pages streaming for large indexes
+    block_size: int = 65536
+    # Keyword-only searches over indexes larger than this are scored on a worker thread to keep the event loop responsive,
+    # vector scoring reads every embedding and always runs on one
+    offload_threshold: int = 50000
+
+    def __init__(self, path: str | Path, embed: Optional[Callable[[str], Awaitable[np.ndarray]]] = None):
+        path = Path(path)
+        with open(path / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+        self.avgdl = meta["avgdl"] or 1.0
+        self.chunks: list[dict[str, Any]] = meta["chunks"]
+        self.term_ids = {term: i for i, term in enumerate(meta["terms"])}
+        self.positions = {chunk["chunk_id"]: i for i, chunk in enumerate(self.chunks)}
+        self.term_offsets = np.load(path / "term_offsets.npy", mmap_mode="r")
+        self.postings_docs = np.load(path / "postings_docs.npy", mmap_mode="r")
+        self.postings_tf = np.load(path / "postings_tf.npy", mmap_mode="r")
+        self.doc_lengths = np.load(path / "doc_lengths.npy", mmap_mode="r")
+        self.embeddings = np.load(path / "embeddings.npy", mmap_mode="r") if (path / "embeddings.npy").exists() else None
+        self.embed = embed if self.embeddings is not None else None
+        self._path = str(path)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def cache_key(self) -> Hashable:
+        return (self._path, self.embed is not None)
+
+    def _bm25(self, query: str, k: int) -> np.ndarray:
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        n = len(self.chunks)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end]
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avgdl)
+            # Each document appears once per term, so plain fancy-index accumulation is safe
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return _top_k(scores, k, positive_only=True)
+
+    def _vector(self, query_vector: np.ndarray, k: int) -> np.ndarray:
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_vector = query_vector / (np.linalg.norm(query_vector) or 1)
+        best_ids = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, len(self.chunks), self.block_size):
+            block_scores = self.embeddings[start:start + self.block_size] @ query_vector
+            block_ids = _top_k(block_scores, k) + start
+            best_ids = np.concatenate([best_ids, block_ids])
+            best_scores = np.concatenate([best_scores, block_scores[block_ids - start]])
+            keep = _top_k(best_scores, k)
+            best_ids, best_scores = best_ids[keep], best_scores[keep]
+        return best_ids
+
+    def _fuse(self, rankings: list[np.ndarray], top: int) -> list[int]:
+        fused: dict[int, float] = {}
+        for ranking in rankings:
+            for rank, doc in enumerate(ranking.tolist()):
+                fused[doc] = fused.get(doc, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        return sorted(fused, key=fused.get, reverse=True)[:top]
+
+    def _rank(self, query: str, query_vector: Optional[np.ndarray], top: int) -> list[int]:
+        rankings = [self._bm25(query, self.candidates)]
+        if query_vector is not None:
+            rankings.append(self._vector(query_vector, self.candidates))
+        return self._fuse(rankings, top)
+
+    async def search(self, query: str, top: int, rerank: bool = True, vector: bool = True) -> list[dict[str, Any]]:
+        started_at = time.perf_counter()
+        query_vector = await self.embed(query) if self.embed is not None and vector else None
+        if query_vector is not None or len(self.chunks) > self.offload_threshold:
+            positions = await asyncio.to_thread(self._rank, query, query_vector, top)
+        else:
+            positions = self._rank(query, query_vector, top)
+        search_seconds.observe(time.perf_counter() - started_at, self.name, "bm25", "true" if query_vector is not None else "false")
+        return [self.chunks[i] for i in positions]
+
+    async def lookup(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        started_at = time.perf_counter()
+        chunks = [self.chunks[self.positions[chunk_id]] for chunk_id in chunk_ids if chunk_id in self.positions]
+        lookup_seconds.observe(time.perf_counter() - started_at, self.name)
+        return chunks
+
+def _top_k(scores: np.ndarray, k: int, positive_only: bool = False) -> np.ndarray:
+    if positive_only:
+        candidates = np.flatnonzero(scores > 0)
+    else:
+        candidates = np.arange(len(scores))
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+class AzureOpenAIEmbedder:
+    """Embeds queries with an Azure OpenAI embedding deployment, for vector retrieval with EmbeddedSearchBackend."""
+
+    def __init__(self, endpoint: str, deployment: str, credentials: Any, dimensions: Optional[int] = None, api_version: str = "2024-06-01"):
+        self.url = f"{endpoint.rstrip('/')}/openai/deployments/{deployment}/embeddings"
+        self.api_version = api_version
+        self.dimensions = dimensions
+        if isinstance(credentials, AzureKeyCredential):
+            self._key = credentials.key
+            self._token_cache = None
+        else:
+            self._key = None
+            self._token_cache = AsyncTokenCache(credentials, "https://cognitiveservices.azure.com/.default")
+            self._token_cache.start()
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __call__(self, text: str) -> np.ndarray:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        headers = {"api-key": self._key} if self._key is not None else {"Authorization": f"Bearer {await self._token_cache.token()}"}
+        body: dict[str, Any] = {"input": text}
+        if self.dimensions:
+            body["dimensions"] = self.dimensions
+        async with self._session.post(self.url, params={"api-version": self.api_version}, headers=headers, json=body) as response:
+            response.raise_for_status()
+            payload = await response.json()
+        return np.asarray(payload["data"][0]["embedding"], dtype=np.float32)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+        if self._token_cache is not None:
+            await self._token_cache.close()
+
+def _read_jsonl(path: str) -> Iterable[dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an index for the embedded retrieval backend from a JSONL file of chunks")
+    parser.add_argument("chunks", help="JSONL file, one chunk per line with chunk_id, title, chunk and optionally text_vector")
+    parser.add_argument("index", help="Directory to write the index to")
+    args = parser.parse_args()
+    started_at = time.perf_counter()
+    count = build_index(_read_jsonl(args.chunks), args.index)
+    print(f"Indexed {count} chunks into {args.index} in {time.perf_counter() - started_at:.2f}s")
@@ -0,0 +1,106 @@
+import asyncio
+import contextlib
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from aiohttp import web
+
+from metrics import REGISTRY
+
+logger = logging.getLogger("voicerag")
+
+_loop_lag_seconds = REGISTRY.histogram("voicerag_event_loop_lag_seconds", "How much later than scheduled the event loop ran a periodic timer, i.e. how long every session's events waited behind other work.")
+
+class LoopLagMonitor:
+    """Measures event loop lag by how late a timer fires, all sessions of a worker share the loop so any
+    synchronous work delays everyone's audio by this much."""
+    interval_seconds: float
+    warn_seconds: float
+    max_lag_seconds: float
+
+    def __init__(self, interval_seconds: float = 0.1, warn_seconds: float = 0.1):
+        self.interval_seconds = interval_seconds
+        self.warn_seconds = warn_seconds
+        # Worst lag since the last scrape
+        self.max_lag_seconds = 0.0
+        self._task: Optional[asyncio.Task] = None
+        REGISTRY.callback("voicerag_event_loop_max_lag_seconds", "Worst event loop lag since the last scrape.", self._take_max_lag)
+
+    def _take_max_lag(self) -> float:
+        max_lag, self.max_lag_seconds = self.max_lag_seconds, 0.0
+        return max_lag
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected_at = loop.time() + self.interval_seconds
+            await asyncio.sleep(self.interval_seconds)
+            lag = max(0.0, loop.time() - expected_at)
+            _loop_lag_seconds.observe(lag)
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+            if lag >= self.warn_seconds:
+                logger.warning("Event loop lagged %.0fms, see voicerag_slow_handlers_total or the profiler for the cause", lag * 1000)
+
+    async def _on_startup(self, app: web.Application) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    def attach_to_app(self, app: web.Application) -> None:
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack from another thread for a fixed window.
+
+    The result is in the folded format ("outer;inner;innermost count" per line) that flamegraph.pl, speedscope and
+    similar tools read. Time the loop spends idle shows up under the selector's select call."""
+    interval_seconds: float
+    max_seconds: float
+
+    def __init__(self, token: str, interval_seconds: float = 0.01, max_seconds: float = 60):
+        self.interval_seconds = interval_seconds
+        self.max_seconds = max_seconds
+        self._token = token
+        self._running = False
+
+    def _sample(self, thread_id: int, seconds: float) -> Counter[str]:
+        stacks: Counter[str] = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if names:
+                stacks[";".join(reversed(names))] += 1
+            time.sleep(self.interval_seconds)
+        return stacks
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        """GET with "Authorization: Bearer <token>" and an optional ?seconds=, returns folded stacks once the window ends."""
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {self._token}".encode()):
+            raise web.HTTPForbidden()
+        try:
+            seconds = min(float(request.query.get("seconds", 10)), self.max_seconds)
+        except ValueError:
+            raise web.HTTPBadRequest(text="seconds must be a number")
+        if self._running:
+            raise web.HTTPConflict(text="A profile is already being recorded")
+        self._running = True
+        try:
+            stacks = await asyncio.to_thread(self._sample, threading.get_ident(), seconds)
+        finally:
+            self._running = False
+        return web.Response(text="".join(f"{stack} {count}\n" for stack, count in stacks.most_common()))
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import re
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, Optional, TypeVar
+
+from aiohttp import web
+
+logger = logging.getLogger("voicerag")
+
+T = TypeVar("T")
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def normalize_query(query: str) -> str:
+    # Spoken queries differ mostly in casing, spacing and trailing punctuation from the transcription
+    return _WHITESPACE_PATTERN.sub(" ", query.casefold()).strip().rstrip("?.!").strip()
+
+class QueryCache:
+    """Bounded in-process cache with per-entry expiry and least-recently-used eviction."""
+    max_entries: int
+    ttl_seconds: float
+    hits: int
+    misses: int
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 300, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        _caches.add(self)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def get_stale(self, key: Hashable) -> Optional[Any]:
+        """Returns the entry even if it expired, expired entries stay until evicted or replaced."""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (self._clock() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+class ChunkStore:
+    """Chunks by identifier with least-recently-used eviction, shared by all sessions of the worker."""
+    max_entries: int
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._chunks: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        _caches.add(self)
+
+    def get(self, chunk_id: str) -> Optional[dict[str, Any]]:
+        chunk = self._chunks.get(chunk_id)
+        if chunk is not None:
+            self._chunks.move_to_end(chunk_id)
+        return chunk
+
+    def put(self, chunk: dict[str, Any]) -> None:
+        if self.max_entries <= 0:
+            return
+        self._chunks[chunk["chunk_id"]] = chunk
+        self._chunks.move_to_end(chunk["chunk_id"])
+        while len(self._chunks) > self.max_entries:
+            self._chunks.popitem(last=False)
+
+    def invalidate(self) -> None:
+        self._chunks.clear()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one in-flight call instead of each making their own.
+
+    The call runs in its own task and callers wait on it shielded, so a caller that is cancelled (e.g. its client
+    disconnected) leaves the call running for everyone else."""
+    calls: int
+    coalesced: int
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Retrieve the exception so it isn't reported as unhandled when every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+_caches: "weakref.WeakSet[QueryCache | ChunkStore]" = weakref.WeakSet()
+
+def invalidate_search_caches() -> None:
+    """Drop every cached search result and chunk in this process, call after the index content changed."""
+    for cache in list(_caches):
+        cache.invalidate()
+
+class IndexChangeWatcher:
+    """Polls a version of the index content, e.g. when the indexer last finished a run, and drops this worker's
+    search caches whenever it changes. Every worker runs its own, so each one notices on its own."""
+    interval_seconds: float
+
+    def __init__(self, version: Callable[[], Awaitable[Optional[Hashable]]], interval_seconds: float = 60):
+        self.interval_seconds = interval_seconds
+        self._version = version
+        self._current: Optional[Hashable] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def check(self) -> bool:
+        """Returns whether the version changed since the last check, a None version (e.g. a run in progress) is skipped."""
+        version = await self._version()
+        if version is None or version == self._current:
+            return False
+        changed = self._current is not None
+        self._current = version
+        if changed:
+            logger.info("Search index content changed (%s), dropping cached search results", version)
+            invalidate_search_caches()
+        return changed
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Could not check whether the search index changed: %s", e)
+            await asyncio.sleep(self.interval_seconds)
+
+    async def _on_startup(self, app: web.Application) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def attach_to_app(self, app: web.Application) -> None:
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
@@ -0,0 +1,93 @@
+from typing import Any, Optional
+
+from metrics import REGISTRY
+
+TOKEN_BUCKETS = (0, 50, 100, 250, 500, 1000, 2000, 4000, 8000)
+
+_result_tokens = REGISTRY.histogram("voicerag_search_result_tokens", "Estimated tokens of search results sent to the model, per search call.", buckets=TOKEN_BUCKETS)
+_tokens_saved = REGISTRY.histogram("voicerag_search_tokens_saved", "Estimated tokens not sent to the model thanks to deduplication, overlap merging and trimming, per search call.", buckets=TOKEN_BUCKETS)
+_tokens_saved_total = REGISTRY.counter("voicerag_search_tokens_saved_total", "Estimated tokens not sent to the model, by reason.", ["reason"])
+
+def estimate_tokens(text: str) -> int:
+    # Close enough for English text with the GPT-4o tokenizer, and free to compute
+    return (len(text) + 3) // 4
+
+def _overlap(first: str, second: str, min_overlap: int, max_overlap: int) -> int:
+    """Length of the longest suffix of first that is also a prefix of second, 0 if shorter than min_overlap."""
+    if len(first) < min_overlap or len(second) < min_overlap:
+        return 0
+    probe = second[:min_overlap]
+    start = max(0, len(first) - max_overlap)
+    while (index := first.find(probe, start)) != -1:
+        if second.startswith(first[index:]):
+            return len(first) - index
+        start = index + 1
+    return 0
+
+class ResultPacker:
+    """Formats search results for the model within a token budget.
+
+    Chunks keep the ranking they came back with. Chunks the model already received earlier in the session are
+    replaced with a reference, text repeated between adjacent chunks of the same document (the split skill overlaps
+    pages) is sent once, and chunks are trimmed once the budget is used up."""
+    max_tokens: int
+    min_overlap: int
+    max_overlap: int
+    # Don't bother sending a trimmed chunk with less text than this
+    min_chunk_tokens: int = 50
+
+    def __init__(self, max_tokens: int = 2500, min_overlap: int = 100, max_overlap: int = 600):
+        self.max_tokens = max_tokens
+        self.min_overlap = min_overlap
+        self.max_overlap = max_overlap
+
+    def pack(self, chunks: list[dict[str, Any]], sent: Optional[set[str]] = None) -> str:
+        """Returns the tool output for chunks, and adds the ids of chunks sent in full to sent."""
+        sent = sent if sent is not None else set()
+        saved = {"repeat": 0, "overlap": 0, "budget": 0}
+        budget = self.max_tokens
+        packed: list[dict[str, Any]] = []
+        parts = []
+        for chunk in chunks:
+            chunk_id, text = chunk["chunk_id"], chunk["chunk"]
+            if chunk_id in sent:
+                saved["repeat"] += estimate_tokens(text)
+                parts.append(f"[{chunk_id}]: (same as the source with this name provided earlier in the conversation)\n-----\n")
+                continue
+
+            note = ""
+            for other in packed:
+                if other["title"] != chunk["title"]:
+                    continue
+                if (overlap := _overlap(other["chunk"], text, self.min_overlap, self.max_overlap)):
+                    note, text = f"(continues {other['chunk_id']}) ", text[overlap:]
+                elif (overlap := _overlap(text, other["chunk"], self.min_overlap, self.max_overlap)):
+                    note, text = f"(continued in {other['chunk_id']}) ", text[:-overlap]
+                else:
+                    continue
+                saved["overlap"] += estimate_tokens(chunk["chunk"]) - estimate_tokens(text)
+                break
+
+            tokens = estimate_tokens(text)
+            if tokens > budget:
+                if budget < self.min_chunk_tokens:
+                    saved["budget"] += tokens
+                    continue
+                # Cut at the last word boundary that fits, the model still gets to cite the source
+                cut = text[:budget * 4]
+                cut = cut[:cut.rfind(" ")] if " " in cut else cut
+                saved["budget"] += tokens - estimate_tokens(cut)
+                text, tokens = cut + " ...", estimate_tokens(cut)
+            else:
+                sent.add(chunk_id)
+            budget -= tokens
+            packed.append(chunk)
+            parts.append(f"[{chunk_id}]: {note}{text}\n-----\n")
+
+        result = "".join(parts)
+        _result_tokens.observe(estimate_tokens(result))
+        _tokens_saved.observe(sum(saved.values()))
+        for reason, tokens in saved.items():
+            if tokens:
+                _tokens_saved_total.inc(reason, amount=tokens)
+        return result
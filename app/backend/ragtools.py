@@ -1,12 +1,30 @@
+import asyncio
+import hashlib
+import json
+import logging
 import re
-from typing import Any
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional
 
+from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
 
-from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from metrics import REGISTRY
+from ragcache import ChunkStore, QueryCache, SingleFlight, normalize_query
+from ragpack import ResultPacker
+from retrieval import AzureSearchBackend, RetrievalBackend
+from rtmt import RealtimeSession, RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from tokencache import AsyncTokenCache
+
+logger = logging.getLogger("voicerag")
+
+_search_hedges = REGISTRY.counter("voicerag_search_hedges_total", "Second searches started because the first took longer than the recent p95.")
+_search_results = REGISTRY.counter("voicerag_search_results_total", "Searches by the result used: primary, hedge, stale (expired cache entry), keyword (keyword-only fallback) or none.", ["result"])
+_tool_deadlines_exceeded = REGISTRY.counter("voicerag_tool_deadline_exceeded_total", "Tool calls whose retrieval didn't finish before the tool's deadline.", ["tool"])
 
 _search_tool_schema = {
     "type": "function",
@@ -49,57 +67,297 @@ _grounding_tool_schema = {
     }
 }
 
+def _session_chunks(session: Optional[RealtimeSession]) -> dict[str, dict[str, Any]]:
+    # Chunks this session has already seen, so grounding can be reported without querying again
+    if session is None:
+        return {}
+    return session.tool_state.setdefault("chunks", {})
+
+def _remember_chunks(chunks: list[dict[str, Any]], session: Optional[RealtimeSession], chunk_store: ChunkStore) -> None:
+    session_chunks = _session_chunks(session)
+    for chunk in chunks:
+        session_chunks[chunk["chunk_id"]] = chunk
+        chunk_store.put(chunk)
+
+class SearchDeadline:
+    """Bounds how long a search waits on the backend.
+
+    Once the search has taken longer than the recent hedge_quantile of search latency, a second one without semantic
+    reranking is started and whichever returns first is used. If neither returns by the deadline, the last cached
+    result for the query is used even if it expired, or else a keyword-only search gets fallback_seconds to answer."""
+    deadline_seconds: float
+    hedge: bool
+    hedge_quantile: float
+    fallback_seconds: float
+    min_samples: int
+
+    def __init__(self, backend: RetrievalBackend, deadline_seconds: float = 5, hedge: bool = True, hedge_quantile: float = 0.95,
+                 fallback_seconds: float = 1, min_samples: int = 20, window: int = 200):
+        self.deadline_seconds = deadline_seconds
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.fallback_seconds = fallback_seconds
+        self.min_samples = min_samples
+        self._backend = backend
+        self._latencies: deque[float] = deque(maxlen=window)
+
+    def hedge_after(self) -> float:
+        if len(self._latencies) < self.min_samples:
+            return self.deadline_seconds / 2
+        latencies = sorted(self._latencies)
+        return min(latencies[int(self.hedge_quantile * (len(latencies) - 1))], self.deadline_seconds)
+
+    async def search(self, query: str, top: int, cache: QueryCache, cache_key: Any) -> tuple[list[dict[str, Any]], str]:
+        """Returns the chunks and which result they came from, raises TimeoutError when there is nothing to return."""
+        try:
+            chunks, result = await self._search(query, top, cache, cache_key)
+        except TimeoutError:
+            _search_results.inc("none")
+            raise
+        _search_results.inc(result)
+        return chunks, result
+
+    async def _search(self, query: str, top: int, cache: QueryCache, cache_key: Any) -> tuple[list[dict[str, Any]], str]:
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        deadline = started_at + self.deadline_seconds
+        primary = asyncio.ensure_future(self._backend.search(query, top))
+        tasks = {primary: "primary"}
+        timed_out = False
+        try:
+            hedge_after = self.hedge_after()
+            # A hedge that would only start at the deadline can't answer in time
+            if self.hedge and hedge_after < self.deadline_seconds:
+                await asyncio.wait([primary], timeout=hedge_after)
+                if not primary.done():
+                    _search_hedges.inc()
+                    tasks[asyncio.ensure_future(self._backend.search(query, top, rerank=False))] = "hedge"
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0, deadline - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    timed_out = True
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), tasks[task]
+                    logger.warning("Search for '%s' failed: %s", query, task.exception())
+        finally:
+            # A cancelled primary still took at least this long, keep it in the window so the p95 isn't biased low
+            if not primary.done() or (not primary.cancelled() and primary.exception() is None):
+                self._latencies.append(loop.time() - started_at)
+            for task in tasks:
+                task.cancel()
+
+        if timed_out:
+            _tool_deadlines_exceeded.inc("search")
+        stale = cache.get_stale(cache_key)
+        if stale is not None:
+            return stale, "stale"
+        try:
+            return await asyncio.wait_for(self._backend.search(query, top, rerank=False, vector=False), self.fallback_seconds), "keyword"
+        except Exception as e:
+            logger.warning("Keyword-only search for '%s' failed: %s", query, repr(e))
+        raise TimeoutError(f"No search result for '{query}' within {self.deadline_seconds}s")
+
+async def _search_chunks(backend: RetrievalBackend, cache: QueryCache, flight: SingleFlight, deadline: Optional[SearchDeadline], top: int, query: str) -> list[dict[str, Any]]:
+    cache_key = (normalize_query(query), backend.cache_key(), top)
+    chunks = cache.get(cache_key)
+    if chunks is not None:
+        logger.debug("Serving '%s' from the search cache.", query)
+        return chunks
+    async def search():
+        logger.info("Searching for '%s' in the knowledge base.", query)
+        if deadline is None:
+            chunks = await backend.search(query, top)
+        else:
+            chunks, result = await deadline.search(query, top, cache, cache_key)
+            # Degraded results answer this call, the next one tries the full query again
+            if result not in ("primary", "hedge"):
+                logger.info("Serving '%s' from a degraded %s search result.", query, result)
+                return chunks
+        cache.put(cache_key, chunks)
+        return chunks
+    # Sessions asking the same question at the same time share one search
+    return await flight.do(cache_key, search)
+
+_STOPWORDS = frozenset(["a", "an", "and", "are", "can", "do", "does", "for", "how", "i", "in", "is", "it", "me", "my", "of", "on", "or", "the", "to", "what", "when", "where", "which", "who", "with"])
+_TERM_PATTERN = re.compile(r"\w+")
+
+def _terms(text: str) -> set[str]:
+    return {t for t in _TERM_PATTERN.findall(normalize_query(text)) if t not in _STOPWORDS}
+
+class SpeculativeSearch:
+    """Starts a search on the user's transcribed question before the model gets around to calling the search tool.
+
+    The model's query is served from the speculative result when enough of its terms appear in the transcript, and only
+    while the transcribed audio is still the turn the model is answering. Transcripts often arrive after the model's
+    call, a speculation left over from an earlier turn is dropped rather than matched against the next question."""
+    min_similarity: float
+    max_age_seconds: float
+    hits: int
+    misses: int
+    time_saved_seconds: float
+
+    def __init__(self, search: Callable[[str], Awaitable[list[dict[str, Any]]]], min_similarity: float = 0.6, max_age_seconds: float = 15):
+        self.min_similarity = min_similarity
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.time_saved_seconds = 0.0
+        self._search = search
+
+    def start(self, transcript: str, item_id: Optional[str], session: RealtimeSession) -> None:
+        if not _terms(transcript) or item_id != session.turn_item_id:
+            session.tool_state.pop("speculative_search", None)
+            return
+        started_at = time.monotonic()
+        async def run():
+            chunks = await self._search(transcript)
+            return chunks, time.monotonic() - started_at
+        task = session.scheduler.run_background(run())
+        session.tool_state["speculative_search"] = (transcript, item_id, started_at, task)
+
+    async def take(self, query: str, session: Optional[RealtimeSession]) -> Optional[list[dict[str, Any]]]:
+        speculation = session.tool_state.pop("speculative_search", None) if session is not None else None
+        if speculation is None:
+            return None
+        transcript, item_id, started_at, task = speculation
+        query_terms = _terms(query)
+        similarity = len(query_terms & _terms(transcript)) / len(query_terms) if query_terms else 0.0
+        if item_id != session.turn_item_id or similarity < self.min_similarity or time.monotonic() - started_at > self.max_age_seconds:
+            self.misses += 1
+            return None
+        # Whatever part of the speculative search already happened is latency the caller doesn't see
+        ahead_by = time.monotonic() - started_at
+        try:
+            chunks, duration = await task
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.time_saved_seconds += min(ahead_by, duration)
+        logger.debug("Serving '%s' from speculative search on '%s'.", query, transcript)
+        return chunks
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "time_saved_seconds": self.time_saved_seconds
+        }
+
 async def _search_tool(
-    search_client: SearchClient, 
-    semantic_configuration: str | None,
-    identifier_field: str,
-    content_field: str,
-    embedding_field: str,
-    use_vector_query: bool,
-    args: Any) -> ToolResult:
-    print(f"Searching for '{args['query']}' in the knowledge base.")
-    # Hybrid query using Azure AI Search with (optional) Semantic Ranker
-    vector_queries = []
-    if use_vector_query:
-        vector_queries.append(VectorizableTextQuery(text=args['query'], k_nearest_neighbors=50, fields=embedding_field))
-    search_results = await search_client.search(
-        search_text=args["query"], 
-        query_type="semantic" if semantic_configuration else "simple",
-        semantic_configuration_name=semantic_configuration,
-        top=5,
-        vector_queries=vector_queries,
-        select=", ".join([identifier_field, content_field])
-    )
-    result = ""
-    async for r in search_results:
-        result += f"[{r[identifier_field]}]: {r[content_field]}\n-----\n"
+    search: Callable[[str], Awaitable[list[dict[str, Any]]]],
+    speculative_search: Optional[SpeculativeSearch],
+    chunk_store: ChunkStore,
+    packer: ResultPacker,
+    args: Any,
+    session: Optional[RealtimeSession]) -> ToolResult:
+    chunks = None
+    if speculative_search is not None:
+        chunks = await speculative_search.take(args["query"], session)
+    if chunks is None:
+        try:
+            chunks = await search(args["query"])
+        except TimeoutError:
+            return ToolResult("The knowledge base didn't respond in time. Tell the user you couldn't look this up right now.", ToolResultDirection.TO_SERVER)
+    _remember_chunks(chunks, session, chunk_store)
+    # Ids of chunks the model has already been given in this conversation
+    sent = session.tool_state.setdefault("sent_chunks", set()) if session is not None else None
+    result = packer.pack(chunks, sent)
     return ToolResult(result, ToolResultDirection.TO_SERVER)
 
 KEY_PATTERN = re.compile(r'^[a-zA-Z0-9_=\-]+$')
 
-# TODO: move from sending all chunks used for grounding eagerly to only sending links to 
-# the original content in storage, it'll be more efficient overall
-async def _report_grounding_tool(search_client: SearchClient, identifier_field: str, title_field: str, content_field: str, args: Any) -> None:
-    sources = [s for s in args["sources"] if KEY_PATTERN.match(s)]
-    list = " OR ".join(sources)
-    print(f"Grounding source: {list}")
-    # Use search instead of filter to align with how detailt integrated vectorization indexes
-    # are generated, where chunk_id is searchable with a keyword tokenizer, not filterable 
-    search_results = await search_client.search(search_text=list, 
-                                                search_fields=[identifier_field], 
-                                                select=[identifier_field, title_field, content_field], 
-                                                top=len(sources), 
-                                                query_type="full")
-    
-    # If your index has a key field that's filterable but not searchable and with the keyword analyzer, you can 
-    # use a filter instead (and you can remove the regex check above, just ensure you escape single quotes)
-    # search_results = await search_client.search(filter=f"search.in(chunk_id, '{list}')", select=["chunk_id", "title", "chunk"])
-
-    docs = []
-    async for r in search_results:
-        docs.append({"chunk_id": r[identifier_field], "title": r[title_field], "chunk": r[content_field]})
+async def _report_grounding_tool(
+    backend: RetrievalBackend,
+    chunk_store: ChunkStore,
+    flight: SingleFlight,
+    deadline_seconds: Optional[float],
+    args: Any,
+    session: Optional[RealtimeSession]) -> ToolResult:
+    sources = list(dict.fromkeys(s for s in args["sources"] if KEY_PATTERN.match(s)))
+    logger.info("Grounding source: %s", " OR ".join(sources))
+
+    # Sources almost always come from a search this session just ran, only go back to the index for the rest
+    session_chunks = _session_chunks(session)
+    found = {}
+    missing = []
+    for source in sources:
+        chunk = session_chunks.get(source) or chunk_store.get(source)
+        if chunk is not None:
+            found[source] = chunk
+        else:
+            missing.append(source)
+
+    if missing:
+        try:
+            fetched = await asyncio.wait_for(flight.do(tuple(sorted(missing)), lambda: backend.lookup(missing)), deadline_seconds)
+        except asyncio.TimeoutError:
+            # Report the sources that are known rather than hold up the answer
+            _tool_deadlines_exceeded.inc("report_grounding")
+            fetched = []
+        _remember_chunks(fetched, session, chunk_store)
+        found.update((chunk["chunk_id"], chunk) for chunk in fetched)
+
+    # Only references go over the websocket with the audio, the client loads content from /chunks when a citation is opened
+    docs = [{"chunk_id": source, "title": found[source]["title"]} for source in sources if source in found]
     return ToolResult({"sources": docs}, ToolResultDirection.TO_CLIENT)
 
+class GroundingContent:
+    """Serves the content of cited chunks over HTTP, from the shared chunk store and the index for chunks it no longer has."""
+    max_ids: int
+    max_age_seconds: int
+
+    def __init__(self, backend: RetrievalBackend, chunk_store: ChunkStore, flight: SingleFlight, max_age_seconds: int = 300, max_ids: int = 50,
+                 owned: Optional[list[Any]] = None):
+        self.max_ids = max_ids
+        self.max_age_seconds = max_age_seconds
+        self._backend = backend
+        self._chunk_store = chunk_store
+        self._flight = flight
+        # Clients and credentials attach_rag_tools created for the tools, closed with close()
+        self._owned = owned or []
+
+    async def close(self) -> None:
+        for resource in self._owned:
+            await resource.close()
+
+    async def chunks(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        found = {}
+        missing = []
+        for chunk_id in chunk_ids:
+            chunk = self._chunk_store.get(chunk_id)
+            if chunk is not None:
+                found[chunk_id] = chunk
+            else:
+                missing.append(chunk_id)
+        if missing:
+            fetched = await self._flight.do(tuple(sorted(missing)), lambda: self._backend.lookup(missing))
+            for chunk in fetched:
+                self._chunk_store.put(chunk)
+                found[chunk["chunk_id"]] = chunk
+        return [found[chunk_id] for chunk_id in chunk_ids if chunk_id in found]
+
+    async def handle_chunks(self, request: web.Request) -> web.Response:
+        """GET /chunks?ids=a,b returns {"chunks": [{"chunk_id", "title", "chunk"}]} for the ids that exist."""
+        chunk_ids = list(dict.fromkeys(i for i in request.query.get("ids", "").split(",") if i))
+        if not chunk_ids or len(chunk_ids) > self.max_ids or not all(KEY_PATTERN.match(i) for i in chunk_ids):
+            return web.json_response({"error": f"ids must be 1 to {self.max_ids} comma separated chunk ids"}, status=400)
+        chunks = await self.chunks(chunk_ids)
+        if not chunks:
+            return web.json_response({"error": "chunks not found"}, status=404)
+        body = json.dumps({"chunks": [{"chunk_id": c["chunk_id"], "title": c["title"], "chunk": c["chunk"]} for c in chunks]}).encode("utf-8")
+        # Strong validator over the exact bytes, so clients revalidate cheaply once max-age runs out
+        headers = {"ETag": f'"{hashlib.sha256(body).hexdigest()[:32]}"', "Cache-Control": f"max-age={self.max_age_seconds}"}
+        if_none_match = request.headers.get("If-None-Match", "")
+        if if_none_match.strip() == "*" or headers["ETag"] in (tag.strip() for tag in if_none_match.split(",")):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", headers=headers)
+
 def attach_rag_tools(rtmt: RTMiddleTier,
     credentials: AzureKeyCredential | DefaultAzureCredential,
     search_endpoint: str, search_index: str,
@@ -108,11 +366,62 @@ def attach_rag_tools(rtmt: RTMiddleTier,
     content_field: str,
     embedding_field: str,
     title_field: str,
-    use_vector_query: bool
-    ) -> None:
-    if not isinstance(credentials, AzureKeyCredential):
-        credentials.get_token("https://search.azure.com/.default") # warm this up before we start getting requests
-    search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
-
-    rtmt.tools["search"] = Tool(schema=_search_tool_schema, target=lambda args: _search_tool(search_client, semantic_configuration, identifier_field, content_field, embedding_field, use_vector_query, args))
-    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, target=lambda args: _report_grounding_tool(search_client, identifier_field, title_field, content_field, args))
+    use_vector_query: bool,
+    top: int = 5,
+    cache_max_entries: int = 256,
+    cache_ttl_seconds: float = 300,
+    shared_chunk_cache_max_entries: int = 1024,
+    speculative_search: bool = False,
+    result_max_tokens: int = 2500,
+    backend: Optional[RetrievalBackend] = None,
+    search_deadline_seconds: float = 5,
+    hedge_search: bool = True,
+    grounding_deadline_seconds: float = 5
+    ) -> GroundingContent:
+    owned = []
+    if backend is None:
+        if not isinstance(credentials, AzureKeyCredential):
+            # The async search client would otherwise call the synchronous credential on the event loop
+            credentials = AsyncTokenCache(credentials, "https://search.azure.com/.default")
+            credentials.start() # warm this up before we start getting requests
+            owned.append(credentials)
+        search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
+        owned.insert(0, search_client)
+        backend = AzureSearchBackend(search_client, semantic_configuration, identifier_field, content_field, embedding_field, title_field, use_vector_query)
+    # Callers ask the same few questions over and over, cache query results to skip the search round trip
+    search_cache = QueryCache(max_entries=cache_max_entries, ttl_seconds=cache_ttl_seconds)
+    # Chunks returned by search, grounding and /chunks resolve from here before they query the index
+    chunk_store = ChunkStore(max_entries=shared_chunk_cache_max_entries)
+
+    # Results sent to the model are capped, overlapping text and chunks it already has aren't sent again
+    packer = ResultPacker(max_tokens=result_max_tokens)
+
+    # Identical searches and lookups already in flight are joined rather than sent to the index again
+    search_flight = SingleFlight()
+    lookup_flight = SingleFlight()
+
+    # Slow searches are hedged and fall back to degraded results rather than leave the caller waiting in silence
+    deadline = SearchDeadline(backend, search_deadline_seconds, hedge=hedge_search) if search_deadline_seconds > 0 else None
+
+    async def search(query: str) -> list[dict[str, Any]]:
+        return await _search_chunks(backend, search_cache, search_flight, deadline, top, query)
+    # Optionally start searching on the input transcription so retrieval overlaps with the model producing its call
+    speculative = SpeculativeSearch(search) if speculative_search else None
+
+    REGISTRY.callback("voicerag_search_cache_hits_total", "Search tool queries served from the result cache.", lambda: search_cache.hits, "counter")
+    REGISTRY.callback("voicerag_search_cache_misses_total", "Search tool queries not in the result cache.", lambda: search_cache.misses, "counter")
+    REGISTRY.callback("voicerag_search_cache_entries", "Queries currently in the search result cache.", lambda: len(search_cache))
+    REGISTRY.callback("voicerag_chunk_store_entries", "Chunks currently in the shared chunk store.", lambda: len(chunk_store))
+    REGISTRY.callback("voicerag_search_coalesced_total", "Search queries that joined an identical search already in flight.", lambda: search_flight.coalesced, "counter")
+    REGISTRY.callback("voicerag_grounding_lookups_coalesced_total", "Grounding lookups that joined an identical lookup already in flight.", lambda: lookup_flight.coalesced, "counter")
+    if speculative is not None:
+        REGISTRY.callback("voicerag_speculative_search_hits_total", "Search calls served from a speculative search.", lambda: speculative.hits, "counter")
+        REGISTRY.callback("voicerag_speculative_search_misses_total", "Speculative searches that didn't match the model's search call.", lambda: speculative.misses, "counter")
+        REGISTRY.callback("voicerag_speculative_search_saved_seconds_total", "Search latency hidden by speculative searches.", lambda: speculative.time_saved_seconds, "counter")
+
+    rtmt.tools["search"] = Tool(schema=_search_tool_schema, 
+                                target=lambda args, session: _search_tool(search, speculative, chunk_store, packer, args, session),
+                                speculate=speculative.start if speculative else None)
+    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, target=lambda args, session: _report_grounding_tool(backend, chunk_store, lookup_flight, grounding_deadline_seconds or None, args, session))
+    # Chunk content can change when documents are re-indexed, let clients keep it as long as the search cache would
+    return GroundingContent(backend, chunk_store, lookup_flight, max_age_seconds=int(cache_ttl_seconds), owned=owned)
@@ -0,0 +1,92 @@
+import time
+from collections.abc import Hashable
+from typing import Any
+
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizableTextQuery
+
+from metrics import REGISTRY
+
+search_seconds = REGISTRY.histogram("voicerag_search_seconds", "Retrieval time for the search tool, by backend and the parts of the hybrid query used.", ["backend", "query_type", "vector"])
+lookup_seconds = REGISTRY.histogram("voicerag_grounding_lookup_seconds", "Retrieval time to fetch grounding chunks not already known.", ["backend"])
+
+class RetrievalBackend:
+    """Where the search and report_grounding tools get chunks from.
+
+    Chunks are dicts with "chunk_id", "title" and "chunk" keys."""
+    name: str = "unknown"
+
+    def cache_key(self) -> Hashable:
+        # Everything besides the query and top that changes which chunks come back
+        return ()
+
+    async def search(self, query: str, top: int, rerank: bool = True, vector: bool = True) -> list[dict[str, Any]]:
+        """rerank=False and vector=False skip those parts of the query where the backend has them, for faster, degraded searches."""
+        raise NotImplementedError
+
+    async def lookup(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        raise NotImplementedError
+
+class AzureSearchBackend(RetrievalBackend):
+    name = "azure_search"
+
+    def __init__(self,
+        search_client: SearchClient,
+        semantic_configuration: str | None,
+        identifier_field: str,
+        content_field: str,
+        embedding_field: str,
+        title_field: str,
+        use_vector_query: bool):
+        self.search_client = search_client
+        self.semantic_configuration = semantic_configuration
+        self.identifier_field = identifier_field
+        self.content_field = content_field
+        self.embedding_field = embedding_field
+        self.title_field = title_field
+        self.use_vector_query = use_vector_query
+
+    def cache_key(self) -> Hashable:
+        return (self.semantic_configuration, self.use_vector_query)
+
+    def _to_chunk(self, r: dict[str, Any]) -> dict[str, Any]:
+        return {"chunk_id": r[self.identifier_field], "title": r[self.title_field], "chunk": r[self.content_field]}
+
+    async def search(self, query: str, top: int, rerank: bool = True, vector: bool = True) -> list[dict[str, Any]]:
+        started_at = time.perf_counter()
+        semantic_configuration = self.semantic_configuration if rerank else None
+        use_vector_query = self.use_vector_query and vector
+        # Hybrid query using Azure AI Search with (optional) Semantic Ranker
+        vector_queries = []
+        if use_vector_query:
+            vector_queries.append(VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields=self.embedding_field))
+        search_results = await self.search_client.search(
+            search_text=query,
+            query_type="semantic" if semantic_configuration else "simple",
+            semantic_configuration_name=semantic_configuration,
+            top=top,
+            vector_queries=vector_queries,
+            select=", ".join([self.identifier_field, self.title_field, self.content_field])
+        )
+        chunks = [self._to_chunk(r) async for r in search_results]
+        # A hybrid query is a single request, so the split is by which parts (keyword, vector, semantic reranking) it used
+        search_seconds.observe(time.perf_counter() - started_at, self.name, "semantic" if semantic_configuration else "simple", "true" if use_vector_query else "false")
+        return chunks
+
+    async def lookup(self, chunk_ids: list[str]) -> list[dict[str, Any]]:
+        started_at = time.perf_counter()
+        # Use search instead of filter to align with how detailt integrated vectorization indexes
+        # are generated, where chunk_id is searchable with a keyword tokenizer, not filterable
+        search_results = await self.search_client.search(search_text=" OR ".join(chunk_ids),
+                                                         search_fields=[self.identifier_field],
+                                                         select=[self.identifier_field, self.title_field, self.content_field],
+                                                         top=len(chunk_ids),
+                                                         query_type="full")
+
+        # If your index has a key field that's filterable but not searchable and with the keyword analyzer, you can
+        # use a filter instead (and you can remove the regex check in ragtools, just ensure you escape single quotes)
+        # search_results = await self.search_client.search(filter=f"search.in(chunk_id, '{','.join(chunk_ids)}')", select=["chunk_id", "title", "chunk"])
+
+        chunks = [self._to_chunk(r) async for r in search_results]
+        lookup_seconds.observe(time.perf_counter() - started_at, self.name)
+        return chunks
@@ -1,16 +1,227 @@
 import asyncio
+import base64
+import hmac
+import itertools
 import json
 import logging
+import re
+import time
+from collections import deque
 from enum import Enum
 from typing import Any, Callable, Optional
 
 import aiohttp
 from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity import DefaultAzureCredential
+
+from audiocodec import CODECS, G711Codec
+from metrics import REGISTRY, RELAY_BUCKETS
+from rtpool import RealtimeConnectionPool
+from silencegate import SilenceGate
+from tokencache import AsyncTokenCache
 
 logger = logging.getLogger("voicerag")
 
+try:
+    import orjson
+
+    def _json_loads(data: str) -> Any:
+        return orjson.loads(data)
+
+    def _json_dumps(value: Any) -> str:
+        return orjson.dumps(value).decode()
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+# Clients and the realtime API both put "type" first, so the event type can be read without parsing the frame.
+# Frames that don't look like this fall back to a full parse.
+_EVENT_TYPE_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+
+def _event_type(data: str) -> Optional[str]:
+    match = _EVENT_TYPE_PATTERN.match(data)
+    return match.group(1) if match else None
+
+def _client_event_type(data: str) -> Optional[str]:
+    # Clients aren't trusted and the realtime API reads a repeated key by its last occurrence, so only microphone audio
+    # skips parsing, and only with a single, unescaped "type" key. Base64 audio contains neither quotes nor backslashes.
+    event_type = _event_type(data)
+    if event_type == "input_audio_buffer.append" and "\\" not in data and data.count('"type"') == 1:
+        return event_type
+    return None
+
+# Clients that connect with ?audio=binary exchange raw PCM16 as binary frames instead of base64 in JSON events,
+# ?audio=g711_ulaw or ?audio=g711_alaw does the same with G.711 encoded frames at the same sample rate.
+# Base64 never contains characters JSON escapes, so both directions are translated without a JSON round trip.
+_AUDIO_DELTA_PATTERN = re.compile(r'"delta"\s*:\s*"([^"]*)"')
+_AUDIO_APPEND_PATTERN = re.compile(r'"audio"\s*:\s*"([^"]*)"')
+
+def _audio_append_event(pcm: bytes) -> str:
+    return '{"type":"input_audio_buffer.append","audio":"' + base64.b64encode(pcm).decode("ascii") + '"}'
+
+def _audio_delta_pcm(data: str) -> Optional[bytes]:
+    match = _AUDIO_DELTA_PATTERN.search(data)
+    return base64.b64decode(match.group(1)) if match else None
+
+def _audio_append_pcm(data: str) -> Optional[bytes]:
+    match = _AUDIO_APPEND_PATTERN.search(data)
+    return base64.b64decode(match.group(1)) if match else None
+
+# Event types clients may send, anything else is reported as "other" so clients can't inflate the metric's label set
+_CLIENT_EVENT_TYPES = frozenset([
+    "session.update",
+    "input_audio_buffer.append",
+    "input_audio_buffer.commit",
+    "input_audio_buffer.clear",
+    "conversation.item.create",
+    "conversation.item.truncate",
+    "conversation.item.delete",
+    "response.create",
+    "response.cancel"
+])
+
+_upstream_connect_seconds = REGISTRY.histogram("voicerag_upstream_connect_seconds", "Time to obtain a realtime API websocket for a new session.", ["pooled"])
+_first_audio_seconds = REGISTRY.histogram("voicerag_turn_first_audio_seconds", "Time from input_audio_buffer.committed to the first response.audio.delta of the answer.")
+_tool_seconds = REGISTRY.histogram("voicerag_tool_seconds", "Tool call execution time.", ["tool"])
+_relay_seconds = REGISTRY.histogram("voicerag_relay_seconds", "Middle tier processing time per relayed event.", ["direction", "event"], RELAY_BUCKETS)
+_rejected_sessions = REGISTRY.counter("voicerag_rejected_sessions_total", "Realtime websocket upgrades refused by admission control, by reason.", ["reason"])
+_relay_coalesced = REGISTRY.counter("voicerag_relay_coalesced_total", "Delta events merged into an earlier queued event because the receiving side fell behind.", ["direction"])
+_slow_handlers = REGISTRY.counter("voicerag_slow_handlers_total", "Relay handlers that held the event loop longer than slow_handler_seconds, by handler and event type.", ["handler", "event"])
+_relay_pauses = REGISTRY.counter("voicerag_relay_pauses_total", "Times reading from one side was paused because the other side's queue passed its high watermark.", ["direction"])
+
+# Delta events that can be merged while they wait to be written: the field holding the delta and whether it's base64 audio
+_COALESCED_EVENTS = {
+    "input_audio_buffer.append": ("audio", True),
+    "response.audio.delta": ("delta", True),
+    "response.audio_transcript.delta": ("delta", False),
+    "response.text.delta": ("delta", False)
+}
+
+def _join_base64(first: str, second: str) -> str:
+    # Unpadded base64 encodes a multiple of 3 bytes, so the strings can simply be concatenated
+    if not first.endswith("="):
+        return first + second
+    return base64.b64encode(base64.b64decode(first) + base64.b64decode(second)).decode("ascii")
+
+class RelayQueue:
+    """Messages waiting to be written to one side of a session, written in order by a single writer task.
+
+    The producer is expected to wait on wait_writable() after put(), which blocks once more than high_watermark
+    bytes are queued until the writer gets below low_watermark. While the writer is behind, i.e. more than low_watermark
+    bytes are queued, consecutive deltas of the same content part are merged into the queued message instead of piling
+    up as separate frames."""
+    direction: str
+    high_watermark: int
+    low_watermark: int
+    bytes: int
+
+    def __init__(self, direction: str, ws: web.WebSocketResponse | aiohttp.ClientWebSocketResponse, high_watermark: int = 1 << 20, low_watermark: int = 256 << 10):
+        self.direction = direction
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.bytes = 0
+        self._ws = ws
+        # [event type, text or binary data or None once merged, parsed message or None, size in bytes]
+        self._entries: deque[list] = deque()
+        self._ready = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._closed = False
+        self._writer: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def put(self, data: str | bytes, event_type: Optional[str] = None) -> None:
+        if self._closed:
+            return
+        # A writer that is keeping up still finds the previous delta of a burst queued, merging it would only add parsing
+        if event_type in _COALESCED_EVENTS and self.bytes > self.low_watermark and self._merge(data, event_type):
+            _relay_coalesced.inc(self.direction)
+        else:
+            self._entries.append([event_type, data, None, len(data)])
+        self.bytes += len(data)
+        if self.bytes > self.high_watermark and self._writable.is_set():
+            self._writable.clear()
+            _relay_pauses.inc(self.direction)
+        self._ready.set()
+
+    async def wait_writable(self) -> None:
+        await self._writable.wait()
+
+    def _find_mergeable(self, event_type: str) -> Optional[list]:
+        # Audio and transcript deltas of a response interleave, look past other deltas but never past anything else
+        for entry in reversed(self._entries):
+            if entry[0] == event_type:
+                return entry
+            if entry[0] not in _COALESCED_EVENTS:
+                return None
+        return None
+
+    def _merge(self, data: str | bytes, event_type: str) -> bool:
+        entry = self._find_mergeable(event_type)
+        if entry is None:
+            return False
+        if isinstance(data, bytes) or isinstance(entry[1], bytes):
+            # Binary frames are bare PCM, they only merge with each other
+            if not (isinstance(data, bytes) and isinstance(entry[1], bytes)):
+                return False
+            entry[1] += data
+            entry[3] += len(data)
+            return True
+        field, is_audio = _COALESCED_EVENTS[event_type]
+        try:
+            if entry[2] is None:
+                entry[2] = _json_loads(entry[1])
+            message = _json_loads(data)
+        except ValueError:
+            return False
+        queued = entry[2]
+        # Malformed frames (a client append or upstream delta without the field) are queued as they are
+        if not isinstance(queued, dict) or not isinstance(message, dict) \
+                or not isinstance(queued.get(field), str) or not isinstance(message.get(field), str):
+            return False
+        if queued.get("item_id") != message.get("item_id") or queued.get("content_index") != message.get("content_index"):
+            return False
+        queued[field] = _join_base64(queued[field], message[field]) if is_audio else queued[field] + message[field]
+        entry[1] = None
+        entry[3] += len(data)
+        return True
+
+    async def _write_loop(self) -> None:
+        try:
+            while True:
+                if not self._entries:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                _, data, message, size = self._entries.popleft()
+                if isinstance(data, bytes):
+                    await self._ws.send_bytes(data)
+                else:
+                    await self._ws.send_str(data if data is not None else _json_dumps(message))
+                self.bytes -= size
+                if self.bytes <= self.low_watermark:
+                    self._writable.set()
+        except ConnectionResetError:
+            # The receiving side is gone, nothing queued for it matters anymore
+            pass
+        finally:
+            self._closed = True
+            self._entries.clear()
+            self.bytes = 0
+            self._writable.set()
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            await asyncio.gather(self._writer, return_exceptions=True)
+
 class ToolResultDirection(Enum):
     TO_SERVER = 1
     TO_CLIENT = 2
@@ -29,12 +240,17 @@ class ToolResult:
         return self.text if type(self.text) == str else json.dumps(self.text)
 
 class Tool:
+    # Called with the parsed arguments and the RealtimeSession that issued the call
     target: Callable[..., ToolResult]
     schema: Any
+    # Optional, called with the transcript of each user turn, the turn's item id and the session, to get a head start on
+    # the call the model is likely to make
+    speculate: Optional[Callable[[str, Optional[str], Any], None]]
 
-    def __init__(self, target: Any, schema: Any):
+    def __init__(self, target: Any, schema: Any, speculate: Optional[Callable[[str, Optional[str], Any], None]] = None):
         self.target = target
         self.schema = schema
+        self.speculate = speculate
 
 class RTToolCall:
     tool_call_id: str
@@ -44,6 +260,108 @@ class RTToolCall:
         self.tool_call_id = tool_call_id
         self.previous_id = previous_id
 
+class RTToolScheduler:
+    """Runs tool calls for one client connection as background tasks so the relay never waits on them."""
+    _tasks: set[asyncio.Task]
+    _pending: list[tuple[RTToolCall, Any, asyncio.Task]]
+
+    def __init__(self):
+        self._tasks = set()
+        self._pending = []
+
+    def _track(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def run_background(self, coro) -> asyncio.Task:
+        # Work that isn't part of a response's tool calls, still cancelled when the session ends
+        return self._track(coro)
+
+    def has_pending(self) -> bool:
+        return len(self._pending) > 0
+
+    def schedule_tool(self, tool_call: RTToolCall, item: Any, coro) -> None:
+        # Tool calls start as soon as their arguments are complete and run concurrently with each other
+        self._pending.append((tool_call, item, self._track(coro)))
+
+    def schedule_after_pending(self, continuation: Callable[[list[tuple[RTToolCall, Any, ToolResult]]], Any]) -> None:
+        # Snapshot the tool calls of the current response; calls from later responses start a new batch.
+        # Results are handed over in the order the model issued the calls, regardless of completion order.
+        batch, self._pending = self._pending, []
+        async def run():
+            results = await asyncio.gather(*[task for _, _, task in batch])
+            try:
+                await continuation([(tool_call, item, result) for (tool_call, item, _), result in zip(batch, results)])
+            except ConnectionResetError:
+                pass
+        self._track(run())
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+class RealtimeSession:
+    """State for a single client connection. Kept small since a worker holds one per live voice session."""
+    __slots__ = ("id", "client_ws", "server_ws", "binary_audio", "codec", "silence_gate", "to_client", "to_server", "tool_calls", "scheduler", "started_at", "timings", "overrides", "tool_state", "turn_item_id")
+
+    def __init__(self, id: int, client_ws: web.WebSocketResponse, binary_audio: bool = False, codec: Optional[G711Codec] = None):
+        self.id = id
+        self.client_ws = client_ws
+        self.server_ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        # Audio to and from the client travels as binary PCM16 frames rather than base64 in JSON events
+        self.binary_audio = binary_audio
+        # Binary frames from and to the client are in this encoding rather than PCM16
+        self.codec = codec
+        self.silence_gate: Optional[SilenceGate] = None
+        # Outgoing messages for each side, their depth is how far behind that side is
+        self.to_client: Optional[RelayQueue] = None
+        self.to_server: Optional[RelayQueue] = None
+        self.tool_calls: dict[str, RTToolCall] = {}
+        self.scheduler = RTToolScheduler()
+        self.started_at = time.monotonic()
+        self.timings: dict[str, float] = {}
+        # Per-session values for the server-enforced configuration below, take precedence over the RTMiddleTier defaults
+        self.overrides: dict[str, Any] = {}
+        # Scratch space for tools that need to remember things across calls within this session
+        self.tool_state: dict[str, Any] = {}
+        # Item id of the user audio committed last, the turn the model is currently answering
+        self.turn_item_id: Optional[str] = None
+
+    async def close(self) -> None:
+        await self.scheduler.close()
+        for queue in (self.to_client, self.to_server):
+            if queue is not None:
+                await queue.close()
+        self.tool_calls.clear()
+
+class RealtimeSessionRegistry:
+    """Live sessions of this worker process."""
+    _sessions: dict[int, RealtimeSession]
+
+    def __init__(self):
+        self._sessions = {}
+        self._ids = itertools.count(1)
+
+    def create(self, client_ws: web.WebSocketResponse, binary_audio: bool = False, codec: Optional[G711Codec] = None) -> RealtimeSession:
+        session = RealtimeSession(next(self._ids), client_ws, binary_audio, codec)
+        self._sessions[session.id] = session
+        return session
+
+    def remove(self, session: RealtimeSession) -> None:
+        self._sessions.pop(session.id, None)
+
+    def get(self, id: int) -> Optional[RealtimeSession]:
+        return self._sessions.get(id)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
 class RTMiddleTier:
     endpoint: str
     deployment: str
@@ -51,7 +369,8 @@ class RTMiddleTier:
     
     # Tools are server-side only for now, though the case could be made for client-side tools
     # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
+    tools: dict[str, Tool]
+    sessions: RealtimeSessionRegistry
 
     # Server-enforced configuration, if set, these will override the client's configuration
     # Typically at least the model name and system message will be set by the server
@@ -62,23 +381,153 @@ class RTMiddleTier:
     disable_audio: Optional[bool] = None
     voice_choice: Optional[str] = None
     api_version: str = "2024-10-01-preview"
-    _tools_pending = {}
-    _token_provider = None
+
+    # Number of realtime connections to keep opened ahead of time per worker, 0 disables pre-warming
+    connection_pool_size: int = 0
+    connection_pool_max_idle_seconds: float = 60
+
+    # Bytes queued for a slow side before the relay stops reading from the other side, and where it resumes
+    relay_high_watermark_bytes: int = 1 << 20
+    relay_low_watermark_bytes: int = 256 << 10
+
+    # Microphone frames quieter than this (in dBFS) aren't sent upstream once the hangover after speech has passed,
+    # None disables the gate. Padding is the audio kept ahead of speech, keep it above server VAD's prefix_padding_ms
+    # and the hangover above its silence_duration_ms.
+    silence_gate_threshold_dbfs: Optional[float] = None
+    silence_gate_hangover_ms: float = 1500
+    silence_gate_padding_ms: float = 500
+
+    # Per-worker admission limits, new sessions past these get a 503 with Retry-After, 0 means unlimited
+    max_sessions: int = 0
+    max_inflight_tool_calls: int = 0
+    retry_after_seconds: int = 5
+    # On shutdown, live sessions get this long to finish before they're closed, keep it below gunicorn's graceful_timeout
+    drain_timeout_seconds: float = 25
+    # Secret for POST /drain, which lets a deploy's pre-stop hook drain the worker while its listener is still open
+    drain_token: Optional[str] = None
+
+    # Relay work is synchronous and holds up every session of the worker, handlers slower than this are counted and logged
+    slow_handler_seconds: float = 0.02
+
+    _token_cache: Optional[AsyncTokenCache] = None
+    _http_session: Optional[aiohttp.ClientSession] = None
+    _connection_pool: Optional[RealtimeConnectionPool] = None
+
+    # The only event types the middle tier ever rewrites, consumes or inspects, everything else (notably audio) is
+    # relayed byte-for-byte without being parsed
+    _rewritten_to_client = frozenset([
+        "session.created",
+        "input_audio_buffer.committed",
+        "conversation.item.input_audio_transcription.completed",
+        "response.output_item.added",
+        "conversation.item.created",
+        "response.function_call_arguments.delta",
+        "response.function_call_arguments.done",
+        "response.output_item.done",
+        "response.done"
+    ])
 
     def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | DefaultAzureCredential, voice_choice: Optional[str] = None):
         self.endpoint = endpoint
         self.deployment = deployment
+        self.tools = {}
+        self.sessions = RealtimeSessionRegistry()
+        self.inflight_tool_calls = 0
+        # Set by drain() through POST /drain, or on shutdown, new sessions are refused and live ones left to finish.
+        # The listener is already closed by the time shutdown starts, only /drain makes /load report it to a load balancer.
+        self.draining = False
+        REGISTRY.callback("voicerag_sessions", "Live realtime sessions in this worker.", lambda: len(self.sessions))
+        REGISTRY.callback("voicerag_inflight_tool_calls", "Tool calls currently executing in this worker.", lambda: self.inflight_tool_calls)
+        REGISTRY.callback("voicerag_draining", "1 while this worker refuses new sessions to drain.", lambda: int(self.draining))
+        REGISTRY.callback("voicerag_relay_queued_bytes", "Bytes waiting to be written to clients and the realtime API across sessions.",
+                          lambda: sum(q.bytes for s in self.sessions for q in (s.to_client, s.to_server) if q is not None))
+        REGISTRY.callback("voicerag_relay_max_session_queued_bytes", "Bytes waiting to be written to the furthest behind side of any session.",
+                          lambda: max((q.bytes for s in self.sessions for q in (s.to_client, s.to_server) if q is not None), default=0))
         self.voice_choice = voice_choice
         if voice_choice is not None:
             logger.info("Realtime voice choice set to %s", voice_choice)
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
         else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
+            self._token_cache = AsyncTokenCache(credentials, "https://cognitiveservices.azure.com/.default")
+            self._token_cache.start() # Warm up during startup so we have a token cached when the first request arrives
+
+    async def _execute_tool(self, tool: Tool, item: Any, rt_session: RealtimeSession) -> ToolResult:
+        started_at = time.perf_counter()
+        self.inflight_tool_calls += 1
+        try:
+            return await tool.target(json.loads(item["arguments"]), rt_session)
+        except Exception:
+            logger.exception("Tool '%s' failed", item["name"])
+            return ToolResult("", ToolResultDirection.TO_SERVER)
+        finally:
+            self.inflight_tool_calls -= 1
+            elapsed = time.perf_counter() - started_at
+            rt_session.timings[f"tool.{item['name']}"] = elapsed
+            _tool_seconds.observe(elapsed, item["name"] if item["name"] in self.tools else "other")
+
+    def _observe_handler(self, handler: str, event: str, seconds: float, rt_session: RealtimeSession) -> None:
+        if seconds >= self.slow_handler_seconds:
+            _slow_handlers.inc(handler, event)
+            logger.warning("Slow %s handler for %s held the event loop for %.1fms in session %s", handler, event, seconds * 1000, rt_session.id)
 
-    async def _process_message_to_client(self, msg: str, client_ws: web.WebSocketResponse, server_ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
+    def _setting(self, rt_session: RealtimeSession, name: str) -> Any:
+        return rt_session.overrides.get(name, getattr(self, name))
+
+    async def _send_tool_outputs(self, outputs: list[tuple[RTToolCall, Any, ToolResult]], rt_session: RealtimeSession) -> None:
+        started_at = time.perf_counter()
+        for tool_call, item, result in outputs:
+            rt_session.to_server.put(_json_dumps({
+                "type": "conversation.item.create",
+                "item": {
+                    "type": "function_call_output",
+                    "call_id": item["call_id"],
+                    "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
+                }
+            }), "conversation.item.create")
+            if result.destination == ToolResultDirection.TO_CLIENT:
+                # TODO: this will break clients that don't know about this extra message, rewrite 
+                # this to be a regular text message with a special marker of some sort
+                rt_session.to_client.put(_json_dumps({
+                    "type": "extension.middle_tier_tool_response",
+                    "previous_item_id": tool_call.previous_id,
+                    "tool_name": item["name"],
+                    "tool_result": result.to_text()
+                }), "extension.middle_tier_tool_response")
+        # A single follow-up response once every output of this turn is in the conversation
+        rt_session.to_server.put(_json_dumps({
+            "type": "response.create"
+        }), "response.create")
+        self._observe_handler("tool_outputs", ",".join(item["name"] if item["name"] in self.tools else "other" for _, item, _ in outputs),
+                              time.perf_counter() - started_at, rt_session)
+
+    def _gate_microphone(self, rt_session: RealtimeSession, msg: str, event_type: Optional[str]) -> list[tuple[str, Optional[str]]]:
+        gate = rt_session.silence_gate
+        if gate is None:
+            return [(msg, event_type)]
+        if event_type == "input_audio_buffer.append":
+            if (pcm := _audio_append_pcm(msg)) is not None:
+                return [(frame, event_type) for frame in gate.filter(msg, pcm)]
+        elif event_type == "input_audio_buffer.commit":
+            # Clients committing on their own expect the buffer to hold everything they sent
+            return [(frame, "input_audio_buffer.append") for frame in gate.flush()] + [(msg, event_type)]
+        elif event_type == "input_audio_buffer.clear":
+            gate.reset()
+        return [(msg, event_type)]
+
+    def _observe_turn(self, event_type: Optional[str], rt_session: RealtimeSession) -> None:
+        if event_type == "input_audio_buffer.committed":
+            rt_session.timings["committed_at"] = time.monotonic()
+        elif event_type == "response.audio.delta" and "committed_at" in rt_session.timings:
+            first_audio = time.monotonic() - rt_session.timings.pop("committed_at")
+            rt_session.timings["first_audio"] = first_audio
+            _first_audio_seconds.observe(first_audio)
+
+    async def _process_message_to_client(self, msg: str, rt_session: RealtimeSession, event_type: Optional[str]) -> Optional[str]:
+        self._observe_turn(event_type, rt_session)
+        if event_type is not None and event_type not in self._rewritten_to_client:
+            return msg.data
+        message = _json_loads(msg.data)
         updated_message = msg.data
         if message is not None:
             match message["type"]:
@@ -88,10 +537,19 @@ class RTMiddleTier:
                     # tools, this will need updating
                     session["instructions"] = ""
                     session["tools"] = []
-                    session["voice"] = self.voice_choice
+                    session["voice"] = self._setting(rt_session, "voice_choice")
                     session["tool_choice"] = "none"
                     session["max_response_output_tokens"] = None
-                    updated_message = json.dumps(message)
+                    updated_message = _json_dumps(message)
+
+                case "input_audio_buffer.committed":
+                    rt_session.turn_item_id = message.get("item_id")
+
+                case "conversation.item.input_audio_transcription.completed":
+                    if transcript := message.get("transcript"):
+                        for tool in self.tools.values():
+                            if tool.speculate is not None:
+                                tool.speculate(transcript, message.get("item_id"), rt_session)
 
                 case "response.output_item.added":
                     if "item" in message and message["item"]["type"] == "function_call":
@@ -100,8 +558,8 @@ class RTMiddleTier:
                 case "conversation.item.created":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+                        if item["call_id"] not in rt_session.tool_calls:
+                            rt_session.tool_calls[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
                         updated_message = None
                     elif "item" in message and message["item"]["type"] == "function_call_output":
                         updated_message = None
@@ -115,114 +573,251 @@ class RTMiddleTier:
                 case "response.output_item.done":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
+                        tool_call = rt_session.tool_calls[message["item"]["call_id"]]
                         tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        result = await tool.target(json.loads(args))
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # TODO: this will break clients that don't know about this extra message, rewrite 
-                            # this to be a regular text message with a special marker of some sort
-                            await client_ws.send_json({
-                                "type": "extension.middle_tier_tool_response",
-                                "previous_item_id": tool_call.previous_id,
-                                "tool_name": item["name"],
-                                "tool_result": result.to_text()
-                            })
+                        rt_session.scheduler.schedule_tool(tool_call, item, self._execute_tool(tool, item, rt_session))
                         updated_message = None
 
                 case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear() # Any chance tool calls could be interleaved across different outstanding responses?
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
+                    if rt_session.scheduler.has_pending():
+                        rt_session.tool_calls.clear() # Any chance tool calls could be interleaved across different outstanding responses?
+                        rt_session.scheduler.schedule_after_pending(lambda outputs: self._send_tool_outputs(outputs, rt_session))
                     if "response" in message:
-                        replace = False
-                        for i, output in enumerate(reversed(message["response"]["output"])):
-                            if output["type"] == "function_call":
-                                message["response"]["output"].pop(i)
-                                replace = True
-                        if replace:
-                            updated_message = json.dumps(message)                        
+                        outputs = message["response"]["output"]
+                        visible_outputs = [output for output in outputs if output["type"] != "function_call"]
+                        if len(visible_outputs) != len(outputs):
+                            message["response"]["output"] = visible_outputs
+                            updated_message = _json_dumps(message)
 
         return updated_message
 
-    async def _process_message_to_server(self, msg: str, ws: web.WebSocketResponse) -> Optional[str]:
-        message = json.loads(msg.data)
+    async def _process_message_to_server(self, msg: str, rt_session: RealtimeSession, event_type: Optional[str]) -> tuple[Optional[str], Optional[str]]:
+        """Returns the frame to send upstream and its event type, event_type is only given for frames that skip parsing."""
+        if event_type is not None:
+            return msg.data, event_type
+        message = _json_loads(msg.data)
         updated_message = msg.data
-        if message is not None:
-            match message["type"]:
+        event_type = message.get("type") if isinstance(message, dict) else None
+        if event_type is not None:
+            match event_type:
                 case "session.update":
                     session = message["session"]
-                    if self.system_message is not None:
-                        session["instructions"] = self.system_message
-                    if self.temperature is not None:
-                        session["temperature"] = self.temperature
-                    if self.max_tokens is not None:
-                        session["max_response_output_tokens"] = self.max_tokens
-                    if self.disable_audio is not None:
-                        session["disable_audio"] = self.disable_audio
-                    if self.voice_choice is not None:
-                        session["voice"] = self.voice_choice
+                    if (system_message := self._setting(rt_session, "system_message")) is not None:
+                        session["instructions"] = system_message
+                    if (temperature := self._setting(rt_session, "temperature")) is not None:
+                        session["temperature"] = temperature
+                    if (max_tokens := self._setting(rt_session, "max_tokens")) is not None:
+                        session["max_response_output_tokens"] = max_tokens
+                    if (disable_audio := self._setting(rt_session, "disable_audio")) is not None:
+                        session["disable_audio"] = disable_audio
+                    if (voice_choice := self._setting(rt_session, "voice_choice")) is not None:
+                        session["voice"] = voice_choice
+                    if any(tool.speculate is not None for tool in self.tools.values()) and not session.get("input_audio_transcription"):
+                        # Speculative tool calls work off the user's transcript
+                        session["input_audio_transcription"] = { "model": "whisper-1" }
                     session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
                     session["tools"] = [tool.schema for tool in self.tools.values()]
-                    updated_message = json.dumps(message)
+                    updated_message = _json_dumps(message)
 
-        return updated_message
+        return updated_message, event_type
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        # One session per worker so connections to the realtime endpoint reuse DNS lookups and keep-alive sockets
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=60)
+            self._http_session = aiohttp.ClientSession(base_url=self.endpoint, connector=connector)
+        return self._http_session
+
+    async def _connect_upstream(self, request_id: Optional[str] = None) -> aiohttp.ClientWebSocketResponse:
+        params = { "api-version": self.api_version, "deployment": self.deployment}
+        headers = {}
+        if request_id is not None:
+            headers["x-ms-client-request-id"] = request_id
+        if self.key is not None:
+            headers["api-key"] = self.key
+        else:
+            headers["Authorization"] = f"Bearer {await self._token_cache.token()}"
+        return await self._get_http_session().ws_connect("/openai/realtime", headers=headers, params=params)
+
+    async def _on_startup(self, app: web.Application) -> None:
+        self._get_http_session()
+        if self._token_cache is not None:
+            self._token_cache.start()
+        if self.connection_pool_size > 0:
+            self._connection_pool = RealtimeConnectionPool(self._connect_upstream, self.connection_pool_size, self.connection_pool_max_idle_seconds)
+            self._connection_pool.start()
+
+    def drain(self) -> None:
+        self.draining = True
+
+    def _admission_error(self) -> Optional[str]:
+        if self.draining:
+            return "draining"
+        if self.max_sessions > 0 and len(self.sessions) >= self.max_sessions:
+            return "sessions"
+        if self.max_inflight_tool_calls > 0 and self.inflight_tool_calls >= self.max_inflight_tool_calls:
+            return "tool_calls"
+        return None
 
-    async def _forward_messages(self, ws: web.WebSocketResponse):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = { "api-version": self.api_version, "deployment": self.deployment}
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = { "api-key": self.key }
-            else:
-                headers = { "Authorization": f"Bearer {self._token_provider()}" } # NOTE: no async version of token provider, maybe refresh token on a timer?
-            async with session.ws_connect("/openai/realtime", headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
-                            if new_msg is not None:
-                                await target_ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
+    def load(self) -> dict[str, Any]:
+        """What a load balancer needs to route on, also served by handle_load."""
+        return {
+            "sessions": len(self.sessions),
+            "max_sessions": self.max_sessions,
+            "inflight_tool_calls": self.inflight_tool_calls,
+            "max_inflight_tool_calls": self.max_inflight_tool_calls,
+            "draining": self.draining,
+            "accepting": self._admission_error() is None
+        }
+
+    def session_stats(self) -> list[dict[str, Any]]:
+        """Age and relay queue depth of each live session, the bytes each side has yet to receive."""
+        now = time.monotonic()
+        return [{
+            "id": s.id,
+            "age_seconds": round(now - s.started_at, 1),
+            "to_client_queued_bytes": s.to_client.bytes if s.to_client is not None else 0,
+            "to_server_queued_bytes": s.to_server.bytes if s.to_server is not None else 0
+        } for s in self.sessions]
+
+    async def handle_load(self, request: web.Request) -> web.Response:
+        load = self.load()
+        if request.query.get("sessions") == "true":
+            load["session_stats"] = self.session_stats()
+        # Probes that only look at the status stop sending sessions to a full or draining worker
+        return web.json_response(load, status=200 if load["accepting"] else 503)
+
+    async def handle_drain(self, request: web.Request) -> web.Response:
+        """POST with "Authorization: Bearer <token>", stops this worker accepting sessions and returns its load."""
+        if self.drain_token is None or not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {self.drain_token}".encode()):
+            raise web.HTTPForbidden()
+        if not self.draining:
+            logger.info("Draining, refusing new realtime sessions while %d live ones finish", len(self.sessions))
+        self.drain()
+        return web.json_response(self.load())
+
+    async def _on_shutdown(self, app: web.Application) -> None:
+        self.drain()
+        deadline = time.monotonic() + self.drain_timeout_seconds
+        while len(self.sessions) > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        if len(self.sessions) > 0:
+            logger.info("Closing %d realtime sessions still open after draining", len(self.sessions))
+        for rt_session in self.sessions:
+            await rt_session.client_ws.close(code=aiohttp.WSCloseCode.GOING_AWAY, message=b"Server shutting down")
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        if self._token_cache is not None:
+            await self._token_cache.close()
+        if self._connection_pool is not None:
+            await self._connection_pool.close()
+        if self._http_session is not None:
+            await self._http_session.close()
+
+    async def _forward_messages(self, ws: web.WebSocketResponse, rt_session: RealtimeSession):
+        target_ws = None
+        connect_started_at = time.perf_counter()
+        request_id = ws.headers.get("x-ms-client-request-id")
+        # Pre-opened connections can't carry the client's request id, connect directly when there is one
+        if self._connection_pool is not None and request_id is None:
+            target_ws = self._connection_pool.take()
+        pooled = target_ws is not None
+        if target_ws is None:
+            target_ws = await self._connect_upstream(request_id)
+        rt_session.timings["upstream_connect"] = time.perf_counter() - connect_started_at
+        _upstream_connect_seconds.observe(rt_session.timings["upstream_connect"], "true" if pooled else "false")
+        try:
+            rt_session.server_ws = target_ws
+            # Each side gets its own writer, so a slow browser holds up neither the realtime API nor tool calls until
+            # its queue passes the high watermark, at which point reading from the realtime API pauses
+            to_server = rt_session.to_server = RelayQueue("to_server", target_ws, self.relay_high_watermark_bytes, self.relay_low_watermark_bytes)
+            to_client = rt_session.to_client = RelayQueue("to_client", ws, self.relay_high_watermark_bytes, self.relay_low_watermark_bytes)
+            to_server.start()
+            to_client.start()
+            if self.silence_gate_threshold_dbfs is not None:
+                rt_session.silence_gate = SilenceGate(self.silence_gate_threshold_dbfs, self.silence_gate_hangover_ms, self.silence_gate_padding_ms)
+
+            async def from_client_to_server():
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        started_at = time.perf_counter()
+                        new_msg, event_type = await self._process_message_to_server(msg, rt_session, _client_event_type(msg.data))
+                        outgoing = self._gate_microphone(rt_session, new_msg, event_type) if new_msg is not None else None
+                        elapsed = time.perf_counter() - started_at
+                        event_label = event_type if event_type in _CLIENT_EVENT_TYPES else "other"
+                        _relay_seconds.observe(elapsed, "to_server", event_label)
+                        self._observe_handler("to_server", event_label, elapsed, rt_session)
+                        if outgoing is not None:
+                            for data, data_type in outgoing:
+                                to_server.put(data, data_type)
+                            await to_server.wait_writable()
+                    elif msg.type == aiohttp.WSMsgType.BINARY and rt_session.binary_audio:
+                        started_at = time.perf_counter()
+                        pcm = rt_session.codec.decode(msg.data) if rt_session.codec is not None else msg.data
+                        new_msg = _audio_append_event(pcm)
+                        # The gate holds append events whatever the client sent, a JSON commit flushes them as they are
+                        new_msgs = rt_session.silence_gate.filter(new_msg, pcm) if rt_session.silence_gate is not None else [new_msg]
+                        elapsed = time.perf_counter() - started_at
+                        _relay_seconds.observe(elapsed, "to_server", "input_audio_buffer.append")
+                        self._observe_handler("to_server", "input_audio_buffer.append", elapsed, rt_session)
+                        for new_msg in new_msgs:
+                            to_server.put(new_msg, "input_audio_buffer.append")
+                        await to_server.wait_writable()
+                    else:
+                        logger.warning("Unexpected message type %s from the client in session %s", msg.type, rt_session.id)
+                
+                # Means it is gracefully closed by the client then time to close the target_ws
+                if target_ws:
+                    logger.info("Closing OpenAI's realtime socket connection for session %s", rt_session.id)
+                    await target_ws.close()
                     
-                    # Means it is gracefully closed by the client then time to close the target_ws
-                    if target_ws:
-                        print("Closing OpenAI's realtime socket connection.")
-                        await target_ws.close()
-                        
-                async def from_server_to_client():
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(msg, ws, target_ws)
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-
-                try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+            async def from_server_to_client():
+                async for msg in target_ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        started_at = time.perf_counter()
+                        event_type = _event_type(msg.data)
+                        new_msg = await self._process_message_to_client(msg, rt_session, event_type)
+                        if rt_session.binary_audio and event_type == "response.audio.delta" and new_msg is not None:
+                            new_msg = _audio_delta_pcm(new_msg)
+                            if rt_session.codec is not None and new_msg is not None:
+                                new_msg = rt_session.codec.encode(new_msg)
+                        elapsed = time.perf_counter() - started_at
+                        _relay_seconds.observe(elapsed, "to_client", event_type or "other")
+                        self._observe_handler("to_client", event_type or "other", elapsed, rt_session)
+                        if new_msg is not None:
+                            to_client.put(new_msg, event_type)
+                            await to_client.wait_writable()
+                    else:
+                        logger.warning("Unexpected message type %s from the realtime API in session %s", msg.type, rt_session.id)
+
+            try:
+                await asyncio.gather(from_client_to_server(), from_server_to_client())
+            except ConnectionResetError:
+                # Ignore the errors resulting from the client disconnecting the socket
+                pass
+        finally:
+            await target_ws.close()
 
     async def _websocket_handler(self, request: web.Request):
+        # Refuse before the upgrade so an overloaded worker spends as little as possible on sessions it can't serve
+        if (reason := self._admission_error()) is not None:
+            _rejected_sessions.inc(reason)
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": str(self.retry_after_seconds)}, text=f"Not accepting new sessions ({reason}), retry later")
+        audio = request.query.get("audio")
+        if audio is not None and audio != "binary" and audio not in CODECS:
+            raise web.HTTPBadRequest(text=f"Unsupported audio format '{audio}', use binary, {' or '.join(CODECS)}")
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        await self._forward_messages(ws)
+        rt_session = self.sessions.create(ws, binary_audio=audio is not None, codec=CODECS.get(audio))
+        try:
+            await self._forward_messages(ws, rt_session)
+        finally:
+            self.sessions.remove(rt_session)
+            await rt_session.close()
         return ws
     
     def attach_to_app(self, app, path):
         app.router.add_get(path, self._websocket_handler)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        app.on_cleanup.append(self._on_cleanup)
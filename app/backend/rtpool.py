@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger("voicerag")
+
+class RealtimeConnectionPool:
+    """Keeps a few realtime websockets opened and authenticated ahead of time so new clients don't wait for the handshake.
+
+    Sockets that sit unused for longer than max_idle_seconds are closed and replaced."""
+    size: int
+    max_idle_seconds: float
+
+    def __init__(self, connect: Callable[[], Awaitable[aiohttp.ClientWebSocketResponse]], size: int, max_idle_seconds: float = 60):
+        self.size = size
+        self.max_idle_seconds = max_idle_seconds
+        self._connect = connect
+        self._idle: deque[tuple[float, aiohttp.ClientWebSocketResponse]] = deque()
+        self._stale: list[aiohttp.ClientWebSocketResponse] = []
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.size > 0 and self._task is None:
+            self._task = asyncio.create_task(self._maintain())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._stale.extend(ws for _, ws in self._idle)
+        self._idle.clear()
+        await self._close_stale()
+
+    def take(self) -> Optional[aiohttp.ClientWebSocketResponse]:
+        now = time.monotonic()
+        while self._idle:
+            opened_at, ws = self._idle.pop()
+            if not ws.closed and now - opened_at < self.max_idle_seconds:
+                self._wake.set()
+                return ws
+            self._stale.append(ws)
+        self._wake.set()
+        return None
+
+    def __len__(self) -> int:
+        return len(self._idle)
+
+    async def _close_stale(self) -> None:
+        stale, self._stale = self._stale, []
+        await asyncio.gather(*[ws.close() for ws in stale], return_exceptions=True)
+
+    async def _maintain(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._idle and (self._idle[0][1].closed or now - self._idle[0][0] >= self.max_idle_seconds):
+                self._stale.append(self._idle.popleft()[1])
+            await self._close_stale()
+            while len(self._idle) < self.size:
+                try:
+                    ws = await self._connect()
+                except Exception as e:
+                    # Back off until the next wake up, new clients still connect directly in the meantime
+                    logger.warning("Could not pre-open realtime connection: %s", e)
+                    break
+                self._idle.append((time.monotonic(), ws))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=min(self.max_idle_seconds / 2, 10))
+            except asyncio.TimeoutError:
+                pass
@@ -1,9 +1,13 @@
+import asyncio
+import hashlib
 import json
 import logging
+import mimetypes
 import os
 import subprocess
+import time
 
-from azure.core.exceptions import ResourceExistsError
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 from azure.identity import AzureDeveloperCliCredential
 from azure.search.documents.indexes import SearchIndexClient, SearchIndexerClient
 from azure.search.documents.indexes.models import (
@@ -15,6 +19,7 @@ from azure.search.documents.indexes.models import (
     HnswParameters,
     IndexProjectionMode,
     InputFieldMappingEntry,
+    NativeBlobSoftDeleteDeletionDetectionPolicy,
     OutputFieldMappingEntry,
     SearchableField,
     SearchField,
@@ -38,10 +43,13 @@ from azure.search.documents.indexes.models import (
     VectorSearchAlgorithmMetric,
     VectorSearchProfile,
 )
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient
 from dotenv import load_dotenv
 from rich.logging import RichHandler
 
+from tokencache import AsyncTokenCache
+
 
 def load_azd_env():
     """Get path to current azd env file and load file using python-dotenv"""
@@ -57,23 +65,29 @@ def load_azd_env():
         raise Exception("No default azd env file found")
     logger.info(f"Loading azd env from {env_file_path}")
     load_dotenv(env_file_path, override=True)
+    return env_file_path
 
 
 def setup_index(azure_credential, index_name, azure_search_endpoint, azure_storage_connection_string, azure_storage_container, azure_openai_embedding_endpoint, azure_openai_embedding_deployment, azure_openai_embedding_model, azure_openai_embeddings_dimensions):
     index_client = SearchIndexClient(azure_search_endpoint, azure_credential)
     indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
 
-    data_source_connections = indexer_client.get_data_source_connections()
-    if index_name in [ds.name for ds in data_source_connections]:
-        logger.info(f"Data source connection {index_name} already exists, not re-creating")
-    else:
+    # Blobs deleted from the container are only dropped from the index through soft delete, which the storage account has enabled
+    data_source_connection = SearchIndexerDataSourceConnection(
+        name=index_name, 
+        type=SearchIndexerDataSourceType.AZURE_BLOB,
+        connection_string=azure_storage_connection_string,
+        container=SearchIndexerDataContainer(name=azure_storage_container),
+        data_deletion_detection_policy=NativeBlobSoftDeleteDeletionDetectionPolicy())
+    data_source_connections = {ds.name: ds for ds in indexer_client.get_data_source_connections()}
+    if index_name not in data_source_connections:
         logger.info(f"Creating data source connection: {index_name}")
-        indexer_client.create_data_source_connection(
-            data_source_connection=SearchIndexerDataSourceConnection(
-                name=index_name, 
-                type=SearchIndexerDataSourceType.AZURE_BLOB,
-                connection_string=azure_storage_connection_string,
-                container=SearchIndexerDataContainer(name=azure_storage_container)))
+        indexer_client.create_data_source_connection(data_source_connection=data_source_connection)
+    elif data_source_connections[index_name].data_deletion_detection_policy is None:
+        logger.info(f"Adding deletion detection to data source connection: {index_name}")
+        indexer_client.create_or_update_data_source_connection(data_source_connection=data_source_connection)
+    else:
+        logger.info(f"Data source connection {index_name} already exists, not re-creating")
 
     index_names = [index.name for index in index_client.list_indexes()]
     if index_name in index_names:
@@ -184,32 +198,111 @@ def setup_index(azure_credential, index_name, azure_search_endpoint, azure_stora
             )
         )
 
-def upload_documents(azure_credential, indexer_name, azure_search_endpoint, azure_storage_endpoint, azure_storage_container):
-    indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
-    # Upload the documents in /data folder to the blob storage container
-    blob_client = BlobServiceClient(
-        account_url=azure_storage_endpoint, credential=azure_credential,
-        max_single_put_size=4 * 1024 * 1024
-    )
-    container_client = blob_client.get_container_client(azure_storage_container)
-    if not container_client.exists():
-        container_client.create_container()
-    existing_blobs = [blob.name for blob in container_client.list_blobs()]
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def _load_manifest(manifest_path):
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def _save_manifest(manifest_path, manifest):
+    if manifest_path is None:
+        return
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
 
-    # Open each file in /data folder
-    for file in os.scandir("data"):
-        with open(file.path, "rb") as opened_file:
-            filename = os.path.basename(file.path)
-            # Check if blob already exists
-            if filename in existing_blobs:
-                logger.info("Blob already exists, skipping file: %s", filename)
-            else:
-                logger.info("Uploading blob for file: %s", filename)
-                blob_client = container_client.upload_blob(filename, opened_file, overwrite=True)
+async def _sync_blobs(azure_credential, azure_storage_endpoint, azure_storage_container, data_path, manifest_path, max_concurrency, delete_removed):
+    # The manifest remembers the MD5 of what was last uploaded for each file, plus its size and mtime so unchanged
+    # files aren't even hashed again. Files it doesn't vouch for are checked against the blob's Content-MD5.
+    # It only vouches for blobs that are still in the container, so blobs deleted there are uploaded again.
+    manifest = _load_manifest(manifest_path)
+    uploaded = manifest.setdefault(f"{azure_storage_endpoint.rstrip('/')}/{azure_storage_container}", {})
+    files = {file.name: file for file in os.scandir(data_path) if file.is_file() and not file.name.startswith(".")}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    stats = {"uploaded": 0, "uploaded_bytes": 0, "unchanged": 0, "deleted": 0, "failed": 0}
+
+    async with AsyncTokenCache(azure_credential, "https://storage.azure.com/.default") as credential, \
+            BlobServiceClient(account_url=azure_storage_endpoint, credential=credential,
+                              max_single_put_size=4 * 1024 * 1024, max_block_size=4 * 1024 * 1024) as blob_service:
+        container_client = blob_service.get_container_client(azure_storage_container)
+        if not await container_client.exists():
+            await container_client.create_container()
+        remote_names = {name async for name in container_client.list_blob_names()}
+
+        async def sync_file(name, file):
+            async with semaphore:
+                stat = file.stat()
+                entry = uploaded.get(name) if name in remote_names else None
+                if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                    stats["unchanged"] += 1
+                    return
+                md5 = await asyncio.to_thread(_file_md5, file.path)
+                record = {"md5": md5, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                if entry is None or entry["md5"] != md5:
+                    blob_client = container_client.get_blob_client(name)
+                    remote_md5 = None
+                    if name in remote_names:
+                        try:
+                            properties = await blob_client.get_blob_properties()
+                            remote_md5 = properties.content_settings.content_md5
+                        except ResourceNotFoundError:
+                            pass
+                    if remote_md5 is None or bytes(remote_md5).hex() != md5:
+                        logger.info("Uploading blob for file: %s", name)
+                        with open(file.path, "rb") as opened_file:
+                            # Files over max_single_put_size go up as blocks, several at a time
+                            await blob_client.upload_blob(opened_file, overwrite=True, max_concurrency=4,
+                                                          content_settings=ContentSettings(content_type=mimetypes.guess_type(name)[0], content_md5=bytes.fromhex(md5)))
+                        stats["uploaded"] += 1
+                        stats["uploaded_bytes"] += stat.st_size
+                        uploaded[name] = record
+                        return
+                stats["unchanged"] += 1
+                uploaded[name] = record
+
+        async def delete_blob(name):
+            async with semaphore:
+                logger.info("Deleting blob for removed file: %s", name)
+                try:
+                    await container_client.delete_blob(name)
+                except ResourceNotFoundError:
+                    pass
+                stats["deleted"] += 1
+                uploaded.pop(name, None)
+
+        jobs = {name: sync_file(name, file) for name, file in files.items()}
+        if delete_removed:
+            for name in remote_names:
+                if name not in files:
+                    jobs[name] = delete_blob(name)
+        results = await asyncio.gather(*jobs.values(), return_exceptions=True)
+        for name, result in zip(jobs, results):
+            if isinstance(result, Exception):
+                logger.error("Could not sync %s: %s", name, result)
+                stats["failed"] += 1
+    _save_manifest(manifest_path, manifest)
+    return stats
+
+def upload_documents(azure_credential, indexer_name, azure_search_endpoint, azure_storage_endpoint, azure_storage_container,
+                     data_path="data", manifest_path=None, max_concurrency=8, delete_removed=False):
+    indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
+    # Upload new and changed documents in the /data folder to the blob storage container
+    started_at = time.monotonic()
+    stats = asyncio.run(_sync_blobs(azure_credential, azure_storage_endpoint, azure_storage_container, data_path, manifest_path, max_concurrency, delete_removed))
+    elapsed = time.monotonic() - started_at
+    logger.info("Blob sync done in %.1fs: %d uploaded (%.1f MB/s), %d unchanged, %d deleted, %d failed",
+                elapsed, stats["uploaded"], stats["uploaded_bytes"] / 1024 / 1024 / max(elapsed, 0.001), stats["unchanged"], stats["deleted"], stats["failed"])
 
     # Start the indexer
     try:
         indexer_client.run_indexer(indexer_name)
+        # The app drops its cached results once the run finishes when AZURE_SEARCH_INDEXER is set, see ragcache.IndexChangeWatcher
         logger.info("Indexer started. Any unindexed blobs should be indexed in a few minutes, check the Azure Portal for status.")
     except ResourceExistsError:
         logger.info("Indexer already running, not starting again")
@@ -221,7 +314,7 @@ if __name__ == "__main__":
 
     logger = logging.getLogger("voicerag")
 
-    load_azd_env()
+    env_file_path = load_azd_env()
 
     logger.info("Checking if we need to set up Azure AI Search index...")
     if os.environ.get("AZURE_SEARCH_REUSE_EXISTING") == "true":
@@ -257,4 +350,8 @@ if __name__ == "__main__":
         indexer_name=AZURE_SEARCH_INDEX,
         azure_search_endpoint=AZURE_SEARCH_ENDPOINT,
         azure_storage_endpoint=AZURE_STORAGE_ENDPOINT,
-        azure_storage_container=AZURE_STORAGE_CONTAINER)
\ No newline at end of file
+        azure_storage_container=AZURE_STORAGE_CONTAINER,
+        # Kept with the azd environment, which isn't checked in
+        manifest_path=os.path.join(os.path.dirname(env_file_path), "blob_manifest.json"),
+        max_concurrency=int(os.environ.get("AZURE_STORAGE_UPLOAD_CONCURRENCY") or 8),
+        delete_removed=os.environ.get("AZURE_STORAGE_DELETE_REMOVED") == "true")
\ No newline at end of file
@@ -0,0 +1,69 @@
+from collections import deque
+from typing import Any
+
+import numpy as np
+
+from metrics import REGISTRY
+
+_gate_frames = REGISTRY.counter("voicerag_silence_gate_frames_total", "Microphone frames seen by the silence gate, by whether they were forwarded to the realtime API.", ["action"])
+_gate_dropped_seconds = REGISTRY.counter("voicerag_silence_gate_dropped_audio_seconds_total", "Seconds of microphone audio the silence gate kept from the realtime API.")
+
+class SilenceGate:
+    """Energy-based gate for one session's microphone audio.
+
+    Frames are forwarded while the signal is above threshold_dbfs and for hangover_ms after it drops below, so server
+    VAD still sees the silence that ends a turn. While the gate is closed, the last padding_ms of audio is held back
+    and forwarded ahead of the next loud frame, covering server VAD's prefix padding, everything older is dropped."""
+    threshold_dbfs: float
+    hangover_seconds: float
+    padding_seconds: float
+
+    def __init__(self, threshold_dbfs: float = -50, hangover_ms: float = 1500, padding_ms: float = 500, sample_rate: int = 24000):
+        self.threshold_dbfs = threshold_dbfs
+        self.hangover_seconds = hangover_ms / 1000
+        self.padding_seconds = padding_ms / 1000
+        self.sample_rate = sample_rate
+        # Mean square of a PCM16 signal at the threshold, so frames are compared without a log or square root
+        self._threshold_mean_square = (32768 * 10 ** (threshold_dbfs / 20)) ** 2
+        self._hangover_left = 0.0
+        self._held: deque[tuple[Any, float]] = deque()
+        self._held_seconds = 0.0
+
+    def is_loud(self, pcm: bytes) -> bool:
+        samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2).astype(np.float32)
+        return samples.size > 0 and float(np.dot(samples, samples)) / samples.size >= self._threshold_mean_square
+
+    def filter(self, frame: Any, pcm: bytes) -> list[Any]:
+        """Returns the frames to forward now, frame is whatever the caller relays (an event or a binary frame)."""
+        seconds = len(pcm) / 2 / self.sample_rate
+        if self.is_loud(pcm):
+            self._hangover_left = self.hangover_seconds
+            forwarded = [held for held, _ in self._held] + [frame]
+            self._held.clear()
+            self._held_seconds = 0.0
+            _gate_frames.inc("forwarded", amount=len(forwarded))
+            return forwarded
+        if self._hangover_left > 0:
+            self._hangover_left -= seconds
+            _gate_frames.inc("forwarded")
+            return [frame]
+        self._held.append((frame, seconds))
+        self._held_seconds += seconds
+        while self._held and self._held_seconds - self._held[0][1] >= self.padding_seconds:
+            _, dropped_seconds = self._held.popleft()
+            self._held_seconds -= dropped_seconds
+            _gate_frames.inc("dropped")
+            _gate_dropped_seconds.inc(amount=dropped_seconds)
+        return []
+
+    def flush(self) -> list[Any]:
+        """Returns held back frames, e.g. before the client commits the input buffer itself."""
+        forwarded = [held for held, _ in self._held]
+        self.reset()
+        _gate_frames.inc("forwarded", amount=len(forwarded))
+        return forwarded
+
+    def reset(self) -> None:
+        self._held.clear()
+        self._held_seconds = 0.0
+        self._hangover_left = 0.0
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import time
+from typing import Any, Optional
+
+from azure.core.credentials import AccessToken, TokenCredential
+
+logger = logging.getLogger("voicerag")
+
+class AsyncTokenCache:
+    """Keeps a bearer token for one scope fresh without ever doing credential I/O on the event loop.
+
+    The wrapped credential is synchronous (DefaultAzureCredential and friends can block for seconds), so it is
+    only ever called on an executor thread, from a background task that refreshes well ahead of expiry.
+    Also usable as an async credential for the Azure SDK clients."""
+    scope: str
+    refresh_margin_seconds: float
+    retry_interval_seconds: float
+
+    def __init__(self, credential: TokenCredential, scope: str, refresh_margin_seconds: float = 300, retry_interval_seconds: float = 30):
+        self.scope = scope
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.retry_interval_seconds = retry_interval_seconds
+        self._credential = credential
+        self._token: Optional[AccessToken] = None
+        self._fetch: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        # Fetches the first token right away, safe to call without a running loop in which case the first token() starts it
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def token(self) -> str:
+        return (await self.get_token(self.scope)).token
+
+    async def get_token(self, *scopes: str, **kwargs: Any) -> AccessToken:
+        if self._token is None or self._token.expires_on <= time.time():
+            self.start()
+            await self._refresh()
+        return self._token
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def __aenter__(self) -> "AsyncTokenCache":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.close()
+
+    async def _refresh(self) -> None:
+        # Concurrent callers share one in-flight fetch
+        if self._fetch is None:
+            self._fetch = asyncio.get_running_loop().run_in_executor(None, self._credential.get_token, self.scope)
+        fetch = self._fetch
+        try:
+            self._token = await asyncio.shield(fetch)
+        finally:
+            if self._fetch is fetch and fetch.done():
+                self._fetch = None
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                await self._refresh()
+                delay = self._token.expires_on - time.time() - self.refresh_margin_seconds
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The current token, if any, keeps being served until it actually expires
+                logger.warning("Could not refresh token for %s: %s", self.scope, e)
+                delay = self.retry_interval_seconds
+            await asyncio.sleep(max(delay, self.retry_interval_seconds))
@@ -0,0 +1,110 @@
+// Measures the audio worklets outside the browser, per 128-sample render quantum.
+//
+// Run from app/frontend, e.g.: node bench/worklets.js --seconds 60
+// Pass --playback or --processor with the path of another version of a worklet to compare them, for example one
+// extracted with git show.
+import fs from "node:fs";
+import { performance } from "node:perf_hooks";
+import { parseArgs } from "node:util";
+
+const SAMPLE_RATE = 24000;
+const QUANTUM = 128;
+const QUANTUM_MS = (QUANTUM / SAMPLE_RATE) * 1000;
+
+const { values: args } = parseArgs({
+    options: {
+        playback: { type: "string", default: "public/audio-playback-worklet.js" },
+        processor: { type: "string", default: "public/audio-processor-worklet.js" },
+        seconds: { type: "string", default: "60" },
+        "chunk-ms": { type: "string", default: "100" },
+        speedup: { type: "string", default: "4" }
+    }
+});
+
+// Evaluates a worklet script against stand-ins for the AudioWorkletGlobalScope and returns an instance of its processor
+function loadWorklet(path, options) {
+    let Processor;
+    class AudioWorkletProcessor {
+        constructor() {
+            this.posted = [];
+            this.port = { onmessage: null, postMessage: (data, transfer) => this.posted.push({ data, transfer }) };
+        }
+    }
+    // A function scope rather than a vm context, whose global lookups would dominate the timings
+    const evaluate = new Function("AudioWorkletProcessor", "registerProcessor", "sampleRate", fs.readFileSync(path, "utf8"));
+    evaluate(AudioWorkletProcessor, (name, cls) => (Processor = cls), SAMPLE_RATE);
+    return new Processor(options);
+}
+
+function summarize(name, timings, extra) {
+    timings.sort((a, b) => a - b);
+    const mean = timings.reduce((a, b) => a + b, 0) / timings.length;
+    const p99 = timings[Math.floor(timings.length * 0.99)];
+    const budget = ((p99 / QUANTUM_MS) * 100).toFixed(2);
+    console.log(
+        `${name}: ${timings.length} quanta, mean ${(mean * 1000).toFixed(2)}us, p99 ${(p99 * 1000).toFixed(2)}us, ` +
+            `max ${(timings[timings.length - 1] * 1000).toFixed(2)}us (${budget}% of the ${QUANTUM_MS.toFixed(2)}ms quantum at p99)` +
+            (extra ? `, ${extra}` : "")
+    );
+}
+
+function speech(samples) {
+    const pcm = new Int16Array(samples);
+    for (let i = 0; i < samples; i++) {
+        pcm[i] = Math.round(8000 * Math.sin((2 * Math.PI * 220 * i) / SAMPLE_RATE) + 1000 * (Math.random() - 0.5));
+    }
+    return pcm;
+}
+
+// An answer arrives in chunks faster than real time (as the realtime API sends it) while it plays
+function benchPlayback(path, seconds, chunkMs, speedup) {
+    const worklet = loadWorklet(path);
+    const chunkSamples = Math.round((SAMPLE_RATE * chunkMs) / 1000);
+    const chunks = Math.ceil((seconds * SAMPLE_RATE) / chunkSamples);
+    const audio = speech(chunkSamples);
+    const output = [[new Float32Array(QUANTUM)]];
+    const quantaPerChunk = chunkSamples / QUANTUM / speedup;
+    const totalQuanta = Math.ceil((seconds * SAMPLE_RATE) / QUANTUM);
+    const timings = [];
+    let sent = 0;
+    const heapBefore = process.memoryUsage().heapUsed;
+    for (let q = 0; q < totalQuanta; q++) {
+        while (sent < chunks && sent <= q / quantaPerChunk) {
+            // Structured clone gives the worklet its own copy, as postMessage would
+            worklet.port.onmessage({ data: audio.slice() });
+            sent++;
+        }
+        const startedAt = performance.now();
+        worklet.process([], output, {});
+        timings.push(performance.now() - startedAt);
+    }
+    const heap = (process.memoryUsage().heapUsed - heapBefore) / 1024 / 1024;
+    summarize("playback", timings, `heap grew ${heap.toFixed(1)}MB`);
+}
+
+function benchProcessor(path, seconds) {
+    const worklet = loadWorklet(path, { processorOptions: { frameSamples: 2400 } });
+    const input = new Float32Array(QUANTUM);
+    const totalQuanta = Math.ceil((seconds * SAMPLE_RATE) / QUANTUM);
+    const timings = [];
+    let posted = 0;
+    let bytes = 0;
+    for (let q = 0; q < totalQuanta; q++) {
+        for (let i = 0; i < QUANTUM; i++) {
+            input[i] = 0.3 * Math.sin((2 * Math.PI * 220 * (q * QUANTUM + i)) / SAMPLE_RATE);
+        }
+        const startedAt = performance.now();
+        worklet.process([[input]], [[new Float32Array(QUANTUM)]], {});
+        timings.push(performance.now() - startedAt);
+        for (const message of worklet.posted) {
+            posted++;
+            bytes += message.data.byteLength;
+        }
+        worklet.posted.length = 0;
+    }
+    summarize("processor", timings, `${(posted / seconds).toFixed(1)} messages/s, ${(bytes / posted).toFixed(0)} bytes each`);
+}
+
+const seconds = Number(args.seconds);
+benchPlayback(args.playback, seconds, Number(args["chunk-ms"]), Number(args.speedup));
+benchProcessor(args.processor, seconds);
@@ -1,31 +1,60 @@
+// Samples queued for playback live in a preallocated ring buffer, so each 128-sample render quantum is a constant
+// amount of work and allocates nothing. The ring doubles when an answer arrives faster than it plays.
+const INITIAL_CAPACITY_SECONDS = 10;
+
 class AudioPlaybackWorklet extends AudioWorkletProcessor {
     constructor() {
         super();
         this.port.onmessage = this.handleMessage.bind(this);
-        this.buffer = [];
+        this.ring = new Float32Array(Math.ceil(sampleRate * INITIAL_CAPACITY_SECONDS));
+        this.readIndex = 0;
+        this.length = 0;
     }
 
     handleMessage(event) {
         if (event.data === null) {
-            this.buffer = [];
+            this.readIndex = 0;
+            this.length = 0;
             return;
         }
-        this.buffer.push(...event.data);
+        this.write(event.data);
     }
 
-    process(inputs, outputs, parameters) {
-        const output = outputs[0];
-        const channel = output[0];
+    write(samples) {
+        if (this.length + samples.length > this.ring.length) {
+            this.grow(this.length + samples.length);
+        }
+        const capacity = this.ring.length;
+        let writeIndex = (this.readIndex + this.length) % capacity;
+        for (let i = 0; i < samples.length; i++) {
+            this.ring[writeIndex] = samples[i] / 32768;
+            writeIndex = writeIndex + 1 === capacity ? 0 : writeIndex + 1;
+        }
+        this.length += samples.length;
+    }
 
-        if (this.buffer.length > channel.length) {
-            const toProcess = this.buffer.slice(0, channel.length);
-            this.buffer = this.buffer.slice(channel.length);
-            channel.set(toProcess.map(v => v / 32768));
-        } else {
-            channel.set(this.buffer.map(v => v / 32768));
-            this.buffer = [];
+    grow(required) {
+        let capacity = this.ring.length * 2;
+        while (capacity < required) {
+            capacity *= 2;
         }
+        const ring = new Float32Array(capacity);
+        const first = Math.min(this.length, this.ring.length - this.readIndex);
+        ring.set(this.ring.subarray(this.readIndex, this.readIndex + first));
+        ring.set(this.ring.subarray(0, this.length - first), first);
+        this.ring = ring;
+        this.readIndex = 0;
+    }
 
+    process(inputs, outputs, parameters) {
+        const channel = outputs[0][0];
+        const count = Math.min(channel.length, this.length);
+        const first = Math.min(count, this.ring.length - this.readIndex);
+        channel.set(this.ring.subarray(this.readIndex, this.readIndex + first));
+        channel.set(this.ring.subarray(0, count - first), first);
+        channel.fill(0, count);
+        this.readIndex = (this.readIndex + count) % this.ring.length;
+        this.length -= count;
         return true;
     }
 }
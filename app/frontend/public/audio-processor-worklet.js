@@ -1,29 +1,37 @@
 const MIN_INT16 = -0x8000;
 const MAX_INT16 = 0x7fff;
+// 100ms at 24kHz, the size of the frames sent to the middle tier
+const DEFAULT_FRAME_SAMPLES = 2400;
 
+// Microphone samples are converted into a frame of frameSamples and posted once full, transferring the frame's buffer
+// rather than copying it, instead of posting a new array every 128-sample render quantum.
 class PCMAudioProcessor extends AudioWorkletProcessor {
-    constructor() {
+    constructor(options) {
         super();
+        this.frameSamples = options?.processorOptions?.frameSamples ?? DEFAULT_FRAME_SAMPLES;
+        this.frame = new Int16Array(this.frameSamples);
+        this.frameLength = 0;
     }
 
     process(inputs, outputs, parameters) {
         const input = inputs[0];
         if (input.length > 0) {
-            const float32Buffer = input[0];
-            const int16Buffer = this.float32ToInt16(float32Buffer);
-            this.port.postMessage(int16Buffer);
+            this.append(input[0]);
         }
         return true;
     }
 
-    float32ToInt16(float32Array) {
-        const int16Array = new Int16Array(float32Array.length);
+    append(float32Array) {
         for (let i = 0; i < float32Array.length; i++) {
             let val = Math.floor(float32Array[i] * MAX_INT16);
             val = Math.max(MIN_INT16, Math.min(MAX_INT16, val));
-            int16Array[i] = val;
+            this.frame[this.frameLength++] = val;
+            if (this.frameLength === this.frameSamples) {
+                this.port.postMessage(this.frame.buffer, [this.frame.buffer]);
+                this.frame = new Int16Array(this.frameSamples);
+                this.frameLength = 0;
+            }
         }
-        return int16Array;
     }
 }
 
@@ -21,12 +21,13 @@ function App() {
     const [selectedFile, setSelectedFile] = useState<GroundingFile | null>(null);
 
     const { startSession, addUserAudio, inputAudioBufferClear } = useRealTime({
+        binaryAudio: true,
         onWebSocketOpen: () => console.log("WebSocket connection opened"),
         onWebSocketClose: () => console.log("WebSocket connection closed"),
         onWebSocketError: event => console.error("WebSocket error:", event),
         onReceivedError: message => console.error("error", message),
-        onReceivedResponseAudioDelta: message => {
-            isRecording && playAudio(message.delta);
+        onReceivedResponseAudio: pcm => {
+            isRecording && playAudio(pcm);
         },
         onReceivedInputAudioBufferSpeechStarted: () => {
             stopAudioPlayer();
@@ -1,12 +1,14 @@
 export class Recorder {
-    onDataAvailable: (buffer: Iterable<number>) => void;
+    onDataAvailable: (buffer: ArrayBuffer) => void;
+    frameSamples: number;
     private audioContext: AudioContext | null = null;
     private mediaStream: MediaStream | null = null;
     private mediaStreamSource: MediaStreamAudioSourceNode | null = null;
     private workletNode: AudioWorkletNode | null = null;
 
-    public constructor(onDataAvailable: (buffer: Iterable<number>) => void) {
+    public constructor(onDataAvailable: (buffer: ArrayBuffer) => void, frameSamples: number) {
         this.onDataAvailable = onDataAvailable;
+        this.frameSamples = frameSamples;
     }
 
     async start(stream: MediaStream) {
@@ -22,9 +24,12 @@ export class Recorder {
             this.mediaStream = stream;
             this.mediaStreamSource = this.audioContext.createMediaStreamSource(this.mediaStream);
 
-            this.workletNode = new AudioWorkletNode(this.audioContext, "audio-processor-worklet");
+            // The worklet posts whole frames of PCM16 samples, each in its own transferred buffer
+            this.workletNode = new AudioWorkletNode(this.audioContext, "audio-processor-worklet", {
+                processorOptions: { frameSamples: this.frameSamples }
+            });
             this.workletNode.port.onmessage = event => {
-                this.onDataAvailable(event.data.buffer);
+                this.onDataAvailable(event.data);
             };
 
             this.mediaStreamSource.connect(this.workletNode);
@@ -1,7 +1,10 @@
+import { useEffect, useState } from "react";
 import { AnimatePresence, motion } from "framer-motion";
 import { X } from "lucide-react";
+import { useTranslation } from "react-i18next";
 
 import { Button } from "./button";
+import { loadChunkContent } from "@/lib/chunks";
 import { GroundingFile } from "@/types";
 
 type Properties = {
@@ -10,6 +13,31 @@ type Properties = {
 };
 
 export default function GroundingFileView({ groundingFile, onClosed }: Properties) {
+    const [content, setContent] = useState<string | null>(null);
+    const [failed, setFailed] = useState(false);
+    const { t } = useTranslation();
+
+    useEffect(() => {
+        setContent(groundingFile?.content ?? null);
+        setFailed(false);
+        if (!groundingFile || groundingFile.content !== undefined) {
+            return;
+        }
+
+        let current = true;
+        loadChunkContent(groundingFile.id)
+            .then(loaded => current && setContent(loaded))
+            .catch(() => current && setFailed(true));
+        return () => {
+            current = false;
+        };
+    }, [groundingFile]);
+
+    let text = content;
+    if (text === null) {
+        text = failed ? t("groundingFiles.loadFailed") : t("groundingFiles.loading");
+    }
+
     return (
         <AnimatePresence>
             {groundingFile && (
@@ -41,7 +69,7 @@ export default function GroundingFileView({ groundingFile, onClosed }: Propertie
                         </div>
                         <div className="flex-grow overflow-hidden">
                             <pre className="h-[40vh] overflow-auto text-wrap rounded-md bg-gray-100 p-4 text-sm">
-                                <code>{groundingFile.content}</code>
+                                <code>{text}</code>
                             </pre>
                         </div>
                     </motion.div>
@@ -12,11 +12,7 @@ export default function useAudioPlayer() {
         audioPlayer.current.init(SAMPLE_RATE);
     };
 
-    const play = (base64Audio: string) => {
-        const binary = atob(base64Audio);
-        const bytes = Uint8Array.from(binary, c => c.charCodeAt(0));
-        const pcmData = new Int16Array(bytes.buffer);
-
+    const play = (pcmData: Int16Array) => {
         audioPlayer.current?.play(pcmData);
     };
 
@@ -1,42 +1,23 @@
 import { useRef } from "react";
 import { Recorder } from "@/components/audio/recorder";
 
+// Bytes of PCM16 per frame sent, 100ms at 24kHz
 const BUFFER_SIZE = 4800;
 
 type Parameters = {
-    onAudioRecorded: (base64: string) => void;
+    onAudioRecorded: (pcm: Uint8Array) => void;
 };
 
 export default function useAudioRecorder({ onAudioRecorded }: Parameters) {
     const audioRecorder = useRef<Recorder>();
 
-    let buffer = new Uint8Array();
-
-    const appendToBuffer = (newData: Uint8Array) => {
-        const newBuffer = new Uint8Array(buffer.length + newData.length);
-        newBuffer.set(buffer);
-        newBuffer.set(newData, buffer.length);
-        buffer = newBuffer;
-    };
-
-    const handleAudioData = (data: Iterable<number>) => {
-        const uint8Array = new Uint8Array(data);
-        appendToBuffer(uint8Array);
-
-        if (buffer.length >= BUFFER_SIZE) {
-            const toSend = new Uint8Array(buffer.slice(0, BUFFER_SIZE));
-            buffer = new Uint8Array(buffer.slice(BUFFER_SIZE));
-
-            const regularArray = String.fromCharCode(...toSend);
-            const base64 = btoa(regularArray);
-
-            onAudioRecorded(base64);
-        }
+    const handleAudioData = (data: ArrayBuffer) => {
+        onAudioRecorded(new Uint8Array(data));
     };
 
     const start = async () => {
         if (!audioRecorder.current) {
-            audioRecorder.current = new Recorder(handleAudioData);
+            audioRecorder.current = new Recorder(handleAudioData, BUFFER_SIZE / 2);
         }
         const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
         audioRecorder.current.start(stream);
@@ -1,6 +1,8 @@
 import useWebSocket from "react-use-websocket";
 
+import { decodeG711, encodeG711 } from "@/lib/g711";
 import {
+    AudioCodec,
     InputAudioBufferAppendCommand,
     InputAudioBufferClearCommand,
     Message,
@@ -19,12 +21,15 @@ type Parameters = {
     aoaiModelOverride?: string;
 
     enableInputAudioTranscription?: boolean;
+    binaryAudio?: boolean; // If true, audio is exchanged with the middle tier as binary PCM16 frames instead of base64 in JSON messages
+    audioCodec?: AudioCodec; // Binary frames are G.711 encoded instead of PCM16, halving the audio bytes, implies binaryAudio
     onWebSocketOpen?: () => void;
     onWebSocketClose?: () => void;
     onWebSocketError?: (event: Event) => void;
     onWebSocketMessage?: (event: MessageEvent<any>) => void;
 
     onReceivedResponseAudioDelta?: (message: ResponseAudioDelta) => void;
+    onReceivedResponseAudio?: (pcm: Int16Array) => void;
     onReceivedInputAudioBufferSpeechStarted?: (message: Message) => void;
     onReceivedResponseDone?: (message: ResponseDone) => void;
     onReceivedExtensionMiddleTierToolResponse?: (message: ExtensionMiddleTierToolResponse) => void;
@@ -39,12 +44,15 @@ export default function useRealTime({
     aoaiApiKeyOverride,
     aoaiModelOverride,
     enableInputAudioTranscription,
+    binaryAudio,
+    audioCodec,
     onWebSocketOpen,
     onWebSocketClose,
     onWebSocketError,
     onWebSocketMessage,
     onReceivedResponseDone,
     onReceivedResponseAudioDelta,
+    onReceivedResponseAudio,
     onReceivedResponseAudioTranscriptDelta,
     onReceivedInputAudioBufferSpeechStarted,
     onReceivedExtensionMiddleTierToolResponse,
@@ -53,10 +61,14 @@ export default function useRealTime({
 }: Parameters) {
     const wsEndpoint = useDirectAoaiApi
         ? `${aoaiEndpointOverride}/openai/realtime?api-key=${aoaiApiKeyOverride}&deployment=${aoaiModelOverride}&api-version=2024-10-01-preview`
-        : `/realtime`;
-
-    const { sendJsonMessage } = useWebSocket(wsEndpoint, {
-        onOpen: () => onWebSocketOpen?.(),
+        : `/realtime${audioCodec ? `?audio=${audioCodec}` : binaryAudio ? "?audio=binary" : ""}`;
+    const useBinaryAudio = (!!binaryAudio || !!audioCodec) && !useDirectAoaiApi;
+
+    const { sendJsonMessage, sendMessage } = useWebSocket(wsEndpoint, {
+        onOpen: event => {
+            (event.target as WebSocket).binaryType = "arraybuffer";
+            onWebSocketOpen?.();
+        },
         onClose: () => onWebSocketClose?.(),
         onError: event => onWebSocketError?.(event),
         onMessage: event => onMessageReceived(event),
@@ -82,10 +94,15 @@ export default function useRealTime({
         sendJsonMessage(command);
     };
 
-    const addUserAudio = (base64Audio: string) => {
+    const addUserAudio = (pcm: Uint8Array) => {
+        if (useBinaryAudio) {
+            sendMessage(audioCodec ? encodeG711(audioCodec, pcm) : pcm);
+            return;
+        }
+
         const command: InputAudioBufferAppendCommand = {
             type: "input_audio_buffer.append",
-            audio: base64Audio
+            audio: btoa(String.fromCharCode(...pcm))
         };
 
         sendJsonMessage(command);
@@ -102,6 +119,12 @@ export default function useRealTime({
     const onMessageReceived = (event: MessageEvent<any>) => {
         onWebSocketMessage?.(event);
 
+        if (event.data instanceof ArrayBuffer) {
+            // Binary frames are response audio, raw PCM16
+            onReceivedResponseAudio?.(audioCodec ? decodeG711(audioCodec, event.data) : new Int16Array(event.data));
+            return;
+        }
+
         let message: Message;
         try {
             message = JSON.parse(event.data);
@@ -114,9 +137,15 @@ export default function useRealTime({
             case "response.done":
                 onReceivedResponseDone?.(message as ResponseDone);
                 break;
-            case "response.audio.delta":
-                onReceivedResponseAudioDelta?.(message as ResponseAudioDelta);
+            case "response.audio.delta": {
+                const delta = message as ResponseAudioDelta;
+                onReceivedResponseAudioDelta?.(delta);
+                if (onReceivedResponseAudio) {
+                    const bytes = Uint8Array.from(atob(delta.delta), c => c.charCodeAt(0));
+                    onReceivedResponseAudio(new Int16Array(bytes.buffer));
+                }
                 break;
+            }
             case "response.audio_transcript.delta":
                 onReceivedResponseAudioTranscriptDelta?.(message as ResponseAudioTranscriptDelta);
                 break;
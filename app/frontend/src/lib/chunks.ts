@@ -0,0 +1,22 @@
+import { ChunksResponse } from "@/types";
+
+// Grounding reports only carry chunk ids and titles, content is fetched from the middle tier the first time it's shown
+const loaded = new Map<string, Promise<string>>();
+
+export function loadChunkContent(id: string): Promise<string> {
+    let content = loaded.get(id);
+    if (!content) {
+        content = fetch(`/chunks?ids=${encodeURIComponent(id)}`)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Loading chunk ${id} failed with status ${response.status}`);
+                }
+                return response.json() as Promise<ChunksResponse>;
+            })
+            .then(result => result.chunks.find(chunk => chunk.chunk_id === id)?.chunk ?? "");
+        // Forget failures so opening the file again retries
+        content.catch(() => loaded.delete(id));
+        loaded.set(id, content);
+    }
+    return content;
+}
@@ -0,0 +1,93 @@
+import { AudioCodec } from "@/types";
+
+// G.711 companding matching the middle tier (app/backend/audiocodec.py), one byte per 16-bit PCM sample
+
+const ULAW_SEGMENT_ENDS = [0x3f, 0x7f, 0xff, 0x1ff, 0x3ff, 0x7ff, 0xfff, 0x1fff];
+const ALAW_SEGMENT_ENDS = [0x1f, 0x3f, 0x7f, 0xff, 0x1ff, 0x3ff, 0x7ff, 0xfff];
+
+function segment(value: number, ends: number[]) {
+    let i = 0;
+    while (i < ends.length && value > ends[i]) {
+        i++;
+    }
+    return i;
+}
+
+function linearToUlaw(sample: number) {
+    let value = sample >> 2;
+    const mask = value < 0 ? 0x7f : 0xff;
+    value = Math.min(Math.abs(value), 8159) + 0x21;
+    const seg = segment(value, ULAW_SEGMENT_ENDS);
+    return (seg >= 8 ? 0x7f : (seg << 4) | ((value >> (seg + 1)) & 0x0f)) ^ mask;
+}
+
+function ulawToLinear(code: number) {
+    const value = ~code & 0xff;
+    const magnitude = (((value & 0x0f) << 3) + 0x84) << ((value >> 4) & 0x07);
+    return value & 0x80 ? 0x84 - magnitude : magnitude - 0x84;
+}
+
+function linearToAlaw(sample: number) {
+    let value = sample >> 3;
+    const mask = value >= 0 ? 0xd5 : 0x55;
+    if (value < 0) {
+        value = -value - 1;
+    }
+    const seg = segment(value, ALAW_SEGMENT_ENDS);
+    if (seg >= 8) {
+        return 0x7f ^ mask;
+    }
+    return ((seg << 4) | ((seg < 2 ? value >> 1 : value >> seg) & 0x0f)) ^ mask;
+}
+
+function alawToLinear(code: number) {
+    const value = code ^ 0x55;
+    const seg = (value & 0x70) >> 4;
+    let magnitude = ((value & 0x0f) << 4) + (seg === 0 ? 8 : 0x108);
+    if (seg > 1) {
+        magnitude <<= seg - 1;
+    }
+    return value & 0x80 ? magnitude : -magnitude;
+}
+
+type Tables = { encode: Uint8Array; decode: Int16Array };
+
+const tables: Partial<Record<AudioCodec, Tables>> = {};
+
+function getTables(codec: AudioCodec): Tables {
+    let result = tables[codec];
+    if (!result) {
+        const [encodeSample, decodeSample] = codec === "g711_ulaw" ? [linearToUlaw, ulawToLinear] : [linearToAlaw, alawToLinear];
+        // Indexed by the unsigned view of the sample, so encoding is a single lookup per sample
+        const encode = new Uint8Array(65536);
+        for (let i = 0; i < 65536; i++) {
+            encode[i] = encodeSample(i < 32768 ? i : i - 65536);
+        }
+        const decode = new Int16Array(256);
+        for (let i = 0; i < 256; i++) {
+            decode[i] = decodeSample(i);
+        }
+        result = tables[codec] = { encode, decode };
+    }
+    return result;
+}
+
+export function encodeG711(codec: AudioCodec, pcm: Uint8Array): Uint8Array {
+    const { encode } = getTables(codec);
+    const samples = new Uint16Array(pcm.buffer, pcm.byteOffset, pcm.byteLength >> 1);
+    const encoded = new Uint8Array(samples.length);
+    for (let i = 0; i < samples.length; i++) {
+        encoded[i] = encode[samples[i]];
+    }
+    return encoded;
+}
+
+export function decodeG711(codec: AudioCodec, data: ArrayBuffer): Int16Array {
+    const { decode } = getTables(codec);
+    const codes = new Uint8Array(data);
+    const pcm = new Int16Array(codes.length);
+    for (let i = 0; i < codes.length; i++) {
+        pcm[i] = decode[codes[i]];
+    }
+    return pcm;
+}
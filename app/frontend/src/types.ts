@@ -1,7 +1,8 @@
 export type GroundingFile = {
     id: string;
     name: string;
-    content: string;
+    // Loaded from /chunks when the file is opened, unless the grounding report included it
+    content?: string;
 };
 
 export type HistoryItem = {
@@ -10,6 +11,8 @@ export type HistoryItem = {
     groundingFiles: GroundingFile[];
 };
 
+export type AudioCodec = "g711_ulaw" | "g711_alaw";
+
 export type SessionUpdateCommand = {
     type: "session.update";
     session: {
@@ -70,5 +73,9 @@ export type ExtensionMiddleTierToolResponse = {
 };
 
 export type ToolResult = {
-    sources: { chunk_id: string; title: string; chunk: string }[];
+    sources: { chunk_id: string; title: string; chunk?: string }[];
+};
+
+export type ChunksResponse = {
+    chunks: { chunk_id: string; title: string; chunk: string }[];
 };
@@ -22,7 +22,8 @@ export default defineConfig({
                 target: "ws://localhost:8765",
                 ws: true,
                 rewriteWsOrigin: true
-            }
+            },
+            "/chunks": "http://localhost:8765"
         }
     }
 });